@@ -1,15 +1,16 @@
 from torch.autograd import grad
 from abc import ABC, abstractmethod
+import math
 import torch
-from torch.utils.data import DataLoader
 from torch.optim import Optimizer
+from itertools import accumulate
 from derpinns.collocations import *
 from derpinns.datasets import *
-from derpinns.sampling import residual_based_adaptive_sampling
+from derpinns.sampling import ResidualBasedAdaptiveSampler, SumTree, torch_generator
+from derpinns.derivatives import DERIVATIVE_ENGINES, evaluate_in_chunks, iter_chunks, jvp_jet
+from derpinns.nn import forward_jet, supports_forward_jet
 from torch.func import jacrev, jacfwd, vmap
 
-torch.autograd.set_detect_anomaly(True)
-
 
 class Closure(ABC):
     """
@@ -22,11 +23,15 @@ class Closure(ABC):
 
         self.x = None
         self.y = None
-        self.mask = None
+        self.classes = None
+        self.offsets = None
+        self.batch_stream = None
 
         self.dtype = None
         self.device = None
         self.optimizer = None
+        self.watchdog = None
+        self.prefetcher = None
 
         self.state = {
             "interior_loss": [],
@@ -60,8 +65,59 @@ class Closure(ABC):
         else:
             raise ValueError("Invalid optimizer")
 
+    def with_watchdog(self, watchdog):
+        self.watchdog = watchdog
+        return self
+
+    def observe(self, **tensors):
+        """
+            Reports tensors to the numerics watchdog, if any. Skipped inside compiled graphs, where the
+            watchdog state would trigger recompilations (non-finite values still reach the loss).
+        """
+        if self.watchdog and not torch.compiler.is_compiling():
+            self.watchdog.observe(**tensors)
+
+    def batches(self):
+        """
+            Endless stream of batches (x, y, classes, counts), walking through the batch sampler epoch
+            after epoch.
+        """
+        while True:
+            for idx, counts in self.batch_sampler:
+                yield (self.dataset.points(idx),
+                       self.dataset.targets(idx),
+                       self.dataset.labels.index_select(0, idx).long(),
+                       counts)
+
+    def with_prefetcher(self, prefetcher):
+        """
+            Takes the batches from a running BatchPrefetcher (None to build them in next_batch again).
+        """
+        self.prefetcher = prefetcher
+        return self
+
+    def produce_batch(self) -> tuple:
+        """
+            Builds the next batch (x, y, classes, counts) without making it current. With a prefetcher it
+            runs on the producer thread, on a copy of the closure holding a snapshot of the model.
+        """
+        return next(self.batch_stream)
+
+    def set_batch(self, batch):
+        self.x, self.y, self.classes, counts = batch
+        self.offsets = list(accumulate(counts, initial=0))
+
     def next_batch(self):
-        self.x, self.y, self.mask = next(iter(self.dataloader))
+        self.set_batch(self.prefetcher.get() if self.prefetcher else self.produce_batch())
+
+    def class_slice(self, c) -> slice:
+        """
+            Contiguous slice of the batch holding the points of class c.
+        """
+        return slice(self.offsets[c], self.offsets[c + 1])
+
+    def class_count(self, c) -> int:
+        return self.offsets[c + 1] - self.offsets[c]
 
     def update_losses_state(self, pde_loss, boundary_loss, initial_cond_loss):
         self.state["interior_loss"].append(pde_loss)
@@ -85,11 +141,56 @@ class Closure(ABC):
         pass
 
     def with_dataset(self, dataset: SampledDataset, loader_opts: dict):
+        """
+            loader_opts: batch_size, shuffle and seed of the class-sorted batch sampler. static=True keeps the
+            same class composition in every batch, quotas sets that composition (see
+            StratifiedClassBatchSampler). A CollocationStream generates its own batches and ignores them.
+        """
         self.dataset = dataset
-        self.dataloader = DataLoader(
-            dataset,
-            **loader_opts
-        )
+        if isinstance(dataset, CollocationStream):
+            # batches are generated by the stream, already class-sorted and with a static composition
+            self.batch_sampler = None
+            self.batch_stream = iter(dataset)
+            return self
+        if loader_opts.get("static", False) or "quotas" in loader_opts:
+            self.batch_sampler = StratifiedClassBatchSampler(
+                dataset.labels,
+                dataset.n_classes,
+                batch_size=loader_opts.get("batch_size", 1),
+                shuffle=loader_opts.get("shuffle", False),
+                quotas=loader_opts.get("quotas"),
+                seed=loader_opts.get("seed")
+            )
+        else:
+            self.batch_sampler = ClassSortedBatchSampler(
+                dataset.labels,
+                dataset.n_classes,
+                batch_size=loader_opts.get("batch_size", 1),
+                shuffle=loader_opts.get("shuffle", False),
+                seed=loader_opts.get("seed")
+            )
+        self.batch_stream = self.batches()
+        return self
+
+    def compile(self, **compile_opts):
+        """
+            Wraps compute_losses (derivatives and losses) in torch.compile. Batches are switched to a static
+            class composition, so the graph is traced once and reused at every step.
+
+            The losses must not rely on double backward (autograd.grad with create_graph), which compiled
+            graphs do not support.
+        """
+        if self.batch_sampler is not None and not isinstance(self.batch_sampler, StratifiedClassBatchSampler):
+            self.batch_sampler = StratifiedClassBatchSampler(
+                self.dataset.labels,
+                self.dataset.n_classes,
+                batch_size=self.batch_sampler.batch_size,
+                shuffle=self.batch_sampler.shuffle,
+                seed=self.batch_sampler.seed
+            )
+            self.batch_stream = self.batches()
+        self.compute_losses = torch.compile(
+            self.compute_losses, **compile_opts)
         return self
 
     def with_model(self, model: torch.nn.Module):
@@ -103,11 +204,22 @@ class Closure(ABC):
 class DimlessBS(Closure):
     """
         Training step of the non-dimensional Black-Scholes PDE.
+
+        Every residual is written as sign_c * (u_tau - tr(A_c u_xx) - b_c . u_x + r u), where c is the point
+        class (label). The diffusion matrices A_c, drift vectors b_c and signs are built once in
+        with_dataset, so residuals of all classes are single batched contractions.
     """
 
     def __init__(self):
         super().__init__()
         self.n_assets = None
+        self.engine = "autograd"
+        self.engine_opts = {}
+        self.split_faces = False
+        self.diffusion_coefs = None
+        self.hessian_coefs = None
+        self.drift_coefs = None
+        self.residual_signs = None
 
     def with_dataset(self, dataset: SampledDataset, loader_opts: dict):
         super().with_dataset(dataset, loader_opts)
@@ -115,173 +227,219 @@ class DimlessBS(Closure):
         self.sigma = dataset.params.sigma
         self.r = dataset.params.r
         self.rho = dataset.params.rho
+        self.diffusion_coefs, self.drift_coefs, self.residual_signs = self.class_operators(
+            dataset.dtype, dataset.device)
+        # the PDE uses u_xx[:, i, j] for i <= j only, which matters when u_xx is not symmetric (FOPINN)
+        self.hessian_coefs = 2 * torch.triu(self.diffusion_coefs, diagonal=1) + \
+            torch.diag_embed(torch.diagonal(
+                self.diffusion_coefs, dim1=-2, dim2=-1))
         return self
 
-    def compute_derivatives(self, x) -> tuple:
-        """
-            Computes all required derivatives using autograd.
-        """
-        x.requires_grad_(True)
-        u = self.model(x)
-        grads = torch.autograd.grad(u.sum(), x, create_graph=True)[0]
-        u_tau = grads[:, -1]
-        u_x = grads[:, :self.n_assets]
-        u_xx_list = []
-        for j in range(self.n_assets):
-            grad_j = torch.autograd.grad(u_x[:, j].sum(), x, create_graph=True,
-                                         retain_graph=True)[0][:, :self.n_assets]
-            u_xx_list.append(grad_j)
-        u_xx = torch.stack(u_xx_list, dim=1)
-
-        if torch.isnan(u_tau).any():
-            raise ValueError("NaN @ u_tau")
-        if torch.isnan(u_x).any():
-            raise ValueError("NaN @ u_x")
-        if torch.isnan(u_xx).any():
-            raise ValueError("NaN @ u_xx")
-        if torch.isnan(u).any():
-            raise ValueError("NaN @ u")
+    def with_derivative_engine(self, engine: str, **engine_opts):
+        """
+            Selects how u_tau, u_x and u_xx are computed:
+            - "autograd": one reverse pass per asset (default).
+            - "vmap": per-sample forward-over-reverse Hessian with torch.func (accepts chunk_size).
+        """
+        if engine in DERIVATIVE_ENGINES:
+            self.engine = engine
+            self.engine_opts = engine_opts
+            return self
+        else:
+            raise ValueError(f"Invalid derivative engine: {engine}")
+
+    def compile(self, **compile_opts):
+        """
+            Compiled graphs do not support double backward, so the autograd engine is replaced by the
+            vmap one, which computes the same derivatives with torch.func.
+        """
+        if self.engine == "autograd":
+            self.engine = "vmap"
+        return super().compile(**compile_opts)
+
+    def with_split_faces(self, split_faces: bool):
+        """
+            If True, the boundary points of each asset get their own derivative group whose Hessian skips
+            that asset. It saves 1/n_assets of the face Hessian work at the cost of one derivative call per
+            asset, which only pays off for large batches.
+        """
+        self.split_faces = split_faces
+        return self
 
+    def class_operators(self, dtype, device):
+        """
+            Diffusion matrix, drift vector and residual sign of every point class, indexed by label. The
+            initial condition class (label 1) has no operator.
+        """
+        n = self.n_assets
+        sigma = torch.as_tensor(self.sigma, dtype=dtype,
+                                device=device).expand(n)
+        rho = torch.as_tensor(self.rho, dtype=dtype, device=device)
+        upper = torch.triu(rho, diagonal=1)
+        A = 0.5 * sigma[:, None] * sigma[None, :] * (upper + upper.T) + \
+            torch.diag(0.5 * sigma**2)
+        b = self.r - 0.5 * sigma**2
+
+        diffusion = torch.zeros(2 + 2*n, n, n, dtype=dtype, device=device)
+        drift = torch.zeros(2 + 2*n, n, dtype=dtype, device=device)
+        signs = -torch.ones(2 + 2*n, dtype=dtype, device=device)
+        diffusion[0], drift[0], signs[0] = A, b, 1.0
+        for i in range(n):
+            keep = torch.ones(n, dtype=dtype, device=device)
+            keep[i] = 0.0
+            A_i = A * keep[:, None] * keep[None, :]
+            # top boundary keeps the r * u_x[:, i] term, bottom boundary drops it
+            diffusion[2 + 2*i] = A_i
+            drift[2 + 2*i] = b * keep
+            drift[2 + 2*i, i] = self.r
+            diffusion[3 + 2*i] = A_i
+            drift[3 + 2*i] = b * keep
+        return diffusion, drift, signs
+
+    def point_classes(self) -> torch.Tensor:
+        """
+            Class (label) of every point of the batch.
+        """
+        return self.classes
+
+    def compute_derivatives(self, x, classes=None, dims=None) -> tuple:
+        """
+            Computes all required derivatives using the selected derivative engine. dims restricts the
+            Hessian to the given assets.
+        """
+        u, u_tau, u_x, u_xx = DERIVATIVE_ENGINES[self.engine](
+            self.model, x, self.n_assets, dims=dims, **self.engine_opts)
+
+        self.observe(u=u, u_tau=u_tau, u_x=u_x, u_xx=u_xx)
         return u, u_tau, u_x, u_xx
 
+    def diffusion_term(self, u_xx, classes) -> torch.Tensor:
+        """
+            tr(A_c u_xx) for a single class c or for per-point classes.
+        """
+        return torch.einsum('...ij,...ij->...', u_xx, self.hessian_coefs[classes])
+
+    def residuals(self, u, u_tau, u_x, u_xx, classes) -> torch.Tensor:
+        """
+            PDE residual of each point under the operator of its class (a single class or per-point classes).
+        """
+        diffusion = self.diffusion_term(u_xx, classes)
+        drift = torch.einsum('...i,...i->...', u_x, self.drift_coefs[classes])
+        return self.residual_signs[classes] * (u_tau - diffusion - drift + self.r * u[:, 0])
+
     def interior_residual(self, u, u_tau, u_x, u_xx) -> torch.Tensor:
-        diffusion = torch.zeros(
-            u.shape[0], dtype=self.dtype, device=self.device)
-        drift = torch.zeros(u.shape[0], dtype=self.dtype, device=self.device)
-        for i in range(self.n_assets):
-            diffusion += 0.5 * self.sigma[i]**2 * u_xx[:, i, i]
-            drift += (self.r - 0.5 * self.sigma[i]**2) * u_x[:, i]
-            for j in range(i+1, self.n_assets):
-                diffusion += self.sigma[i] * self.sigma[j] * \
-                    self.rho[i, j] * u_xx[:, i, j]
-
-        reaction = self.r * u.squeeze()
-        residual = u_tau - diffusion - drift + reaction
-        return residual
+        return self.residuals(u, u_tau, u_x, u_xx, 0)
 
-    def __top_i_boundary_residual(self, u, u_tau, u_x, u_xx, i) -> torch.Tensor:
-        drift_sum = torch.zeros(
-            u_x.shape[0], dtype=self.dtype, device=self.device)
-        for j in range(self.n_assets):
-            drift_sum += self.r * u_x[:, j]
-
-        cross_diffusion = torch.zeros(
-            u_xx.shape[0], dtype=self.dtype, device=self.device)
-        for k in range(self.n_assets):
-            for j in range(k+1, self.n_assets):
-                if k != i and j != i:
-                    cross_diffusion += 2 * self.sigma[k] * \
-                        self.sigma[j] * self.rho[k, j] * u_xx[:, k, j]
-
-        pure_diffusion = torch.zeros(
-            u_xx.shape[0],  dtype=self.dtype, device=self.device)
-        for j in range(self.n_assets):
-            if j != i:
-                pure_diffusion += self.sigma[j]**2 * \
-                    (u_xx[:, j, j] - u_x[:, j])
-
-        residual = -u_tau + drift_sum + 0.5 * \
-            (cross_diffusion + pure_diffusion) - self.r * u.squeeze()
+    def interior_residual_at(self, x) -> torch.Tensor:
+        """
+            Interior PDE residual at arbitrary points x [N, n_assets + 1].
+        """
+        u, u_tau, u_x, u_xx = self.compute_derivatives(x)
+        return self.interior_residual(u, u_tau, u_x, u_xx)
 
-        return residual
+    def iter_interior_residuals(self, x, chunk_size=None):
+        """
+            Streams (start, |residual|) over x chunk_size points at a time (see derivatives.iter_chunks), for
+            point clouds whose derivatives do not fit in memory at once. x may live on the host.
+        """
+        for start, residual in iter_chunks(self.interior_residual_at, x, chunk_size, self.dtype, self.device):
+            yield start, residual.abs()
 
-    def __bottom_i_boundary_residual(self, u, u_tau, u_x, u_xx, i):
-        drift_sum = torch.zeros(
-            u_x.shape[0], dtype=self.dtype, device=self.device)
-        for j in range(self.n_assets):
-            if j != i:
-                drift_sum += self.r * u_x[:, j]
-
-        cross_diffusion = torch.zeros(
-            u_xx.shape[0], dtype=self.dtype, device=self.device)
-        for k in range(self.n_assets):
-            for j in range(k+1, self.n_assets):
-                if k != i and j != i:
-                    cross_diffusion += 2 * self.sigma[k] * \
-                        self.sigma[j] * self.rho[k, j] * u_xx[:, k, j]
-
-        pure_diffusion = torch.zeros(
-            u_xx.shape[0], dtype=self.dtype, device=self.device)
-        for j in range(self.n_assets):
-            if j != i:
-                pure_diffusion += self.sigma[j]**2 * \
-                    (u_xx[:, j, j] - u_x[:, j])
-
-        residual = -u_tau + drift_sum + 0.5 * \
-            (cross_diffusion + pure_diffusion) - self.r * u.squeeze()
-        return residual
+    def interior_residuals(self, x, chunk_size=None, out_device=None) -> torch.Tensor:
+        """
+            |Interior residual| at every point of x, evaluated chunk by chunk and gathered on out_device.
+        """
+        return torch.cat([residual.to(out_device) for _, residual in self.iter_interior_residuals(x, chunk_size)])
 
     def boundary_loss(self, u, u_tau, u_x, u_xx) -> list[torch.Tensor]:
         """
             Computes the loss of all boundaries (top and bottom).
         """
+        # all faces in one contraction, then one mean per face slice
+        faces = slice(self.offsets[2], self.offsets[-1])
+        residual = self.residuals(
+            u[faces], u_tau[faces], u_x[faces], u_xx[faces], self.classes[faces])
         losses = torch.zeros(
             self.n_assets*2, dtype=self.dtype, device=self.device)
         for i in range(self.n_assets):
-            mask_top_i = self.mask[:, 2 + 2*i].bool()
-            mask_bottom_i = self.mask[:, 3 + 2*i].bool()
+            top_i = self.face_slice(2 + 2*i)
+            bottom_i = self.face_slice(3 + 2*i)
 
             # Bottom boundary
-            if mask_bottom_i.sum() > 0:
-                br = self.__bottom_i_boundary_residual(
-                    u[mask_bottom_i],
-                    u_tau[mask_bottom_i],
-                    u_x[mask_bottom_i],
-                    u_xx[mask_bottom_i],
-                    i
-                )
-                losses[2*i] = br.square().mean()
+            if self.class_count(3 + 2*i) > 0:
+                losses[2*i] = residual[bottom_i].square().mean()
 
             # Top boundary
-            if mask_top_i.sum() > 0:
-                tr = self.__top_i_boundary_residual(
-                    u[mask_top_i],
-                    u_tau[mask_top_i],
-                    u_x[mask_top_i],
-                    u_xx[mask_top_i],
-                    i
-                )
-                losses[2*i + 1] = tr.square().mean()
+            if self.class_count(2 + 2*i) > 0:
+                losses[2*i + 1] = residual[top_i].square().mean()
         return losses
 
+    def face_slice(self, c) -> slice:
+        """
+            Slice of boundary class c relative to the start of the boundary points.
+        """
+        return slice(self.offsets[c] - self.offsets[2], self.offsets[c + 1] - self.offsets[2])
+
     def initial_residual(self, u, y) -> torch.Tensor:
         return u - y
 
-    def compute_losses(self):
+    def derivative_plan(self) -> list:
         """
-            The training step. Computes all losses and returns the total.
+            Groups of consecutive point classes that need the same derivatives, as tuples
+            (first class, last class, order, dims). Order 0 only needs u; order 2 needs u_tau, u_x and the
+            Hessian in the assets listed in dims (None for all of them).
+
+            Initial condition points only need u. The two faces of asset i do not use its Hessian row,
+            which is exploited when split_faces is set.
         """
-        # self.optimizer.zero_grad()
-        u, u_tau, u_x, u_xx = self.compute_derivatives(self.x)
-
-        # PDE residual: interi or loss
-        interior_mask = self.mask[:, 0].bool()
-        if interior_mask.sum() > 0:
-            interior_loss = self.interior_residual(
-                u[interior_mask],
-                u_tau[interior_mask],
-                u_x[interior_mask],
-                u_xx[interior_mask]
-            ).square().mean()
-        else:
-            interior_loss = torch.tensor(
-                0.0, dtype=self.dtype, device=self.device)
-
-        # Initial condition loss
-        initial_mask = self.mask[:, 1].bool()
-        if initial_mask.sum() > 0:
-            initial_loss = self.initial_residual(
-                u[initial_mask],
-                self.y[initial_mask]
-            ).square().mean()
-        else:
-            initial_loss = torch.tensor(
-                0.0, dtype=self.dtype, device=self.device)
+        n = self.n_assets
+        plan = [(0, 0, 2, None), (1, 1, 0, None)]
+        if not self.split_faces:
+            return plan + [(2, 1 + 2*n, 2, None)]
+        for i in range(n):
+            plan.append((2 + 2*i, 3 + 2*i, 2, [j for j in range(n) if j != i]))
+        return plan
+
+    def class_residual(self, c, u, u_tau=None, u_x=None, u_xx=None) -> torch.Tensor:
+        """
+            Residual of the points of class c given their derivatives.
+        """
+        if c == 0:
+            return self.interior_residual(u, u_tau, u_x, u_xx)
+        if c == 1:
+            return self.initial_residual(u, self.y[self.class_slice(1)])
+        return self.residuals(u, u_tau, u_x, u_xx, c)
 
-        boundary_losses = self.boundary_loss(
-            u, u_tau, u_x, u_xx)
+    def compute_losses(self):
+        """
+            The training step. Computes all losses and returns the total.
 
-        return interior_loss, boundary_losses, initial_loss
+            Derivatives are computed group by group following derivative_plan, so the Hessian is only
+            built for the points and assets whose residual uses it.
+        """
+        losses = torch.zeros(
+            2 + 2*self.n_assets, dtype=self.dtype, device=self.device)
+        for first, last, order, dims in self.derivative_plan():
+            group = slice(self.offsets[first], self.offsets[last + 1])
+            if group.start == group.stop:
+                continue
+            if order == 0:
+                derivatives = (self.model(self.x[group]),)
+            else:
+                derivatives = self.compute_derivatives(
+                    self.x[group], self.classes[group], dims)
+
+            for c in range(first, last + 1):
+                if self.class_count(c) > 0:
+                    rows = slice(
+                        self.offsets[c] - group.start, self.offsets[c + 1] - group.start)
+                    losses[c] = self.class_residual(
+                        c, *[d[rows] for d in derivatives]).square().mean()
+
+        # boundary losses are ordered bottom, top for each asset
+        boundary_order = [c for i in range(self.n_assets)
+                          for c in (3 + 2*i, 2 + 2*i)]
+        return losses[0], losses[boundary_order], losses[1]
 
     def __call__(self, *args, **kwargs):
         """
@@ -300,44 +458,267 @@ class ResidualBasedAdaptiveSamplingDimlessBS(DimlessBS):
         Implementation of the residual-based adaptive sampling method.
         https://www.sciencedirect.com/science/article/pii/S0045782522006260?via%3Dihub
 
-        The main disadvantage of this kind of methods is that is does not allow mini-batching.
+        The interior points of every batch are replaced by points drawn from a pool of pool_factor times
+        as many candidates, kept on the training device (see sampling.ResidualBasedAdaptiveSampler). The
+        pool and its residuals are refreshed every refresh_every steps (refresh_fraction of it), and the
+        residuals are evaluated in chunks of chunk_size points (one batch of interior points by default).
     """
 
-    def __init__(self,  sampler='Halton', k=1, c=1, seed=None):
+    def __init__(self,  sampler='Halton', k=1, c=1, seed=None, pool_factor=10, refresh_every=10, refresh_fraction=0.25, chunk_size=None):
         super().__init__()
 
         self.sampler = sampler
         self.seed = seed
         self.k = k
         self.c = c
+        self.pool_factor = pool_factor
+        self.refresh_every = refresh_every
+        self.refresh_fraction = refresh_fraction
+        self.chunk_size = chunk_size
+        self.adaptive_sampler = None
+
+    def produce_batch(self) -> tuple:
+        x, y, classes, counts = super().produce_batch()
+
+        # interior points come first
+        n_samples = counts[0]
+        if n_samples == 0:
+            return x, y, classes, counts
+        if self.adaptive_sampler is None or n_samples > self.adaptive_sampler.pool_size:
+            self.adaptive_sampler = ResidualBasedAdaptiveSampler(
+                self.dataset.params.domain_ranges(),
+                pool_size=self.pool_factor * n_samples,
+                k=self.k,
+                c=self.c,
+                sampler=self.sampler,
+                refresh_every=self.refresh_every,
+                refresh_fraction=self.refresh_fraction,
+                chunk_size=self.chunk_size or n_samples,
+                seed=self.seed,
+                dtype=self.dtype,
+                device=self.device
+            )
+        # a new tensor, stream batches may still be in use by the training step
+        x = torch.cat([self.adaptive_sampler.sample(self.interior_residual_at, n_samples), x[n_samples:]])
+        return x, y, classes, counts
+
+
+def resident_interior_size(dataset, name) -> int:
+    """
+        Number of interior points of a dataset with persistent, class-sorted points, which are then its
+        first rows. Used by the closures that keep per-point state.
+    """
+    if isinstance(dataset, CollocationStream):
+        raise ValueError(f"{name} needs a dataset with persistent points")
+    labels = dataset.labels
+    if bool((labels[1:] < labels[:-1]).any()):
+        raise ValueError(f"{name} needs a class-sorted dataset")
+    return int((labels == 0).sum())
+
+
+class PrioritizedReplayDimlessBS(DimlessBS):
+    """
+        Residual-based adaptive sampling from a persistent buffer: the interior points of every batch are
+        drawn from the interior points of the dataset with probabilities proportional to
+        |r|^k / mean(|r|^k) + c, where r is the residual of the last time the point was trained on.
+
+        The raw |r|^k live in a sum-tree (see sampling.SumTree) and are updated from the residuals of
+        compute_losses, so no extra residuals are evaluated. The floor c is not stored in the tree: the
+        distribution is the mixture of proportional sampling (weight 1 / (1 + c)) and uniform sampling
+        (weight c / (1 + c)). The buffer starts uniform.
+    """
+
+    def __init__(self, k=1, c=1, seed=None):
+        super().__init__()
+        self.k = k
+        self.c = c
+        self.seed = seed
+        self.priorities = None
+        self.generator = None
+        self.replay_idx = None
+        self.replay_residual = None
+
+    def with_dataset(self, dataset: SampledDataset, loader_opts: dict):
+        n_interior = resident_interior_size(dataset, "Prioritized replay")
+        super().with_dataset(dataset, loader_opts)
+        self.priorities = SumTree(n_interior, dtype=dataset.dtype, device=dataset.device)
+        self.priorities.fill(1.0)
+        self.generator = torch_generator(self.seed, dataset.device)
+        return self
 
     def next_batch(self):
-        # Get the next batch of data
         super().next_batch()
+        self.replay_idx = None
+        n_samples = self.class_count(0)
+        if n_samples == 0:
+            return
+        self.replay_idx = self.sample_replay(n_samples)
+        self.x[self.class_slice(0)] = self.dataset.points(self.replay_idx)
+
+    def sample_replay(self, n_samples) -> torch.Tensor:
+        """
+            Buffer indices drawn from the mixture of proportional and uniform sampling (without a host sync).
+        """
+        proportional = self.priorities.sample(n_samples, self.generator)
+        uniform = torch.randint(self.priorities.n_leaves, (n_samples,),
+                                generator=self.generator, device=proportional.device)
+        pick = torch.rand(n_samples, generator=self.generator, device=proportional.device) * (1 + self.c) < 1
+        # all residuals at zero leave only the uniform part
+        pick &= self.priorities.total > 0
+        return torch.where(pick, proportional, uniform)
+
+    def class_residual(self, c, u, u_tau=None, u_x=None, u_xx=None) -> torch.Tensor:
+        residual = super().class_residual(c, u, u_tau, u_x, u_xx)
+        if c == 0:
+            self.replay_residual = residual.detach()
+        return residual
 
-        interior_mask = self.mask[:, 0].bool()
-        n_samples = self.x[interior_mask].shape[0]
-
-        def res_f(x):
-            x = torch.tensor(x, dtype=self.dtype,
-                             device=self.device)
-            u, u_tau, u_x, u_xx = self.compute_derivatives(x)
-            return self.interior_residual(u, u_tau, u_x, u_xx).detach().cpu().numpy()
-
-        tmp_x = residual_based_adaptive_sampling(
-            res_f,
-            n_samples,
-            self.dataset.params.domain_ranges(),
-            k=self.k,
-            c=self.c,
-            sampler=self.sampler,
-            seed=self.seed
-        )
-        # we need to modify the tmp_x to be in the same range as the original x
-        tmp_x = torch.tensor(tmp_x, dtype=self.dtype,
-                             device=self.device)
+    def update_priorities(self):
+        self.priorities.update(self.replay_idx, self.replay_residual.abs().reshape(-1) ** self.k)
+
+    def __call__(self, *args, **kwargs):
+        loss = super().__call__(*args, **kwargs)
+        if self.replay_idx is not None and self.replay_residual is not None:
+            self.update_priorities()
+        self.replay_residual = None
+        return loss
+
+
+class ActiveSetDimlessBS(DimlessBS):
+    """
+        Active-set training: every score_every steps the interior residuals of the active points are
+        evaluated (chunk_size points at a time, one batch by default) and the quantile fraction with the
+        lowest ones moves to a cold set, keeping at least min_active of the interior points active. Batches
+        take their interior points from the active set, and every revisit_every-th batch from the cold set:
+        cold points whose residual is back above the threshold of the last scoring return to the active set.
+
+        The interior slice shrinks to the size of the set when it is smaller than the one given by the batch
+        sampler, so the step cost falls with the active set. With a static class composition (a
+        StratifiedClassBatchSampler, also set by compile()) the slice is padded instead, by walking through the
+        set again, to the next power of two (capped at the sampler's size), so only a few batch shapes are
+        ever traced. The active fraction after every change is stored in state["active_fraction"].
+    """
+
+    def __init__(self, quantile=0.5, score_every=100, revisit_every=10, min_active=0.1, chunk_size=None, seed=None):
+        super().__init__()
+        if not 0 < quantile < 1 or not 0 < min_active <= 1:
+            raise ValueError("Invalid active set settings")
+        self.quantile = quantile
+        self.score_every = score_every
+        self.revisit_every = revisit_every
+        self.min_active = min_active
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.generator = None
+        self.active = None
+        self.threshold = None
+        self.sets = {}
+        self.cursors = {}
+        self.steps = 0
+        self.revisit_idx = None
+        self.revisit_residual = None
+        self.state["active_fraction"] = []
+
+    def with_dataset(self, dataset: SampledDataset, loader_opts: dict):
+        n_interior = resident_interior_size(dataset, "Active-set training")
+        super().with_dataset(dataset, loader_opts)
+        self.active = torch.ones(n_interior, dtype=torch.bool, device=dataset.device)
+        self.generator = torch_generator(self.seed, dataset.device)
+        self.update_sets()
+        return self
+
+    def update_sets(self):
+        """
+            Shuffled indices of the active (True) and cold (False) interior points.
+        """
+        for active in (True, False):
+            idx = (self.active == active).nonzero().flatten()
+            self.sets[active] = idx[torch.randperm(len(idx), generator=self.generator, device=idx.device)]
+            self.cursors[active] = 0
+        self.state["active_fraction"].append(len(self.sets[True]) / len(self.active))
+
+    def take(self, active, k) -> torch.Tensor:
+        """
+            Next k points of a set, walking through it and reshuffling when exhausted (several times if
+            the set has less than k points).
+        """
+        parts = []
+        while k > 0:
+            idx = self.sets[active]
+            if self.cursors[active] == len(idx):
+                self.sets[active] = idx = idx[torch.randperm(len(idx), generator=self.generator, device=idx.device)]
+                self.cursors[active] = 0
+            start = self.cursors[active]
+            parts.append(idx[start:start + k])
+            self.cursors[active] = start + len(parts[-1])
+            k -= len(parts[-1])
+        return torch.cat(parts)
+
+    def score(self):
+        """
+            Moves the active points with the lowest residuals to the cold set.
+        """
+        idx = self.active.nonzero().flatten()
+        n_cold = min(int(self.quantile * len(idx)), len(idx) - math.ceil(self.min_active * len(self.active)))
+        if n_cold <= 0:
+            return
+        residual = evaluate_in_chunks(
+            lambda chunk: self.interior_residual_at(self.dataset.points(chunk)), idx,
+            self.chunk_size or max(self.class_count(0), 1)).abs()
+        order = residual.argsort()
+        self.active[idx[order[:n_cold]]] = False
+        self.threshold = residual[order[n_cold]]
+        self.update_sets()
+
+    def next_batch(self):
+        super().next_batch()
+        self.steps += 1
+        if self.steps % self.score_every == 0:
+            self.score()
+
+        n_samples = self.class_count(0)
+        if n_samples == 0:
+            return
+        revisit = self.steps % self.revisit_every == 0 and len(self.sets[False]) > 0
+        k = self.interior_size(n_samples, len(self.sets[not revisit]))
+        idx = self.take(not revisit, k)
+        self.revisit_idx = idx if revisit else None
+        if k == n_samples:
+            self.x[self.class_slice(0)] = self.dataset.points(idx)
+            return
+        counts = [self.class_count(c) for c in range(len(self.offsets) - 1)]
+        counts[0] = k
+        self.set_batch((torch.cat([self.dataset.points(idx), self.x[n_samples:]]),
+                        torch.cat([self.dataset.targets(idx), self.y[n_samples:]]),
+                        torch.cat([self.classes.new_zeros(k), self.classes[n_samples:]]),
+                        counts))
+
+    def interior_size(self, n_samples, set_size) -> int:
+        """
+            Size of the interior slice: the set size, rounded up to a power of two for static batches.
+        """
+        if set_size >= n_samples:
+            return n_samples
+        if isinstance(self.batch_sampler, StratifiedClassBatchSampler):
+            return min(1 << (set_size - 1).bit_length(), n_samples)
+        return set_size
+
+    def class_residual(self, c, u, u_tau=None, u_x=None, u_xx=None) -> torch.Tensor:
+        residual = super().class_residual(c, u, u_tau, u_x, u_xx)
+        if c == 0 and self.revisit_idx is not None:
+            self.revisit_residual = residual.detach()
+        return residual
 
-        self.x[interior_mask] = tmp_x
+    def __call__(self, *args, **kwargs):
+        loss = super().__call__(*args, **kwargs)
+        if self.revisit_residual is not None:
+            back = self.revisit_idx[self.revisit_residual.abs().reshape(-1) >= self.threshold]
+            if len(back):
+                self.active[back] = True
+                self.update_sets()
+        self.revisit_idx = None
+        self.revisit_residual = None
+        return loss
 
 
 class LossBalancingDimlessBS(DimlessBS):
@@ -347,7 +728,7 @@ class LossBalancingDimlessBS(DimlessBS):
     """
 
     def __init__(self, alpha: torch.Tensor, tau: torch.Tensor, rho_prob: torch.Tensor):
-        super(DimlessBS).__init__()
+        super().__init__()
         self.alpha = alpha
         self.tau = tau
         self.rho_prob = rho_prob
@@ -403,43 +784,27 @@ class PINNBoundaryDimlessBS(DimlessBS):
     """
 
     def __init__(self):
-        super(DimlessBS).__init__()
+        super().__init__()
 
     def with_dataset(self, dataset: SampledDatasetWithPINNBoundary, loader_opts: dict):
-        super().with_dataset(dataset, loader_opts)
-        self.n_assets = dataset.params.n_assets
-        self.sigma = dataset.params.sigma
-        self.r = dataset.params.r
-        self.rho = dataset.params.rho
-        return self
+        return super().with_dataset(dataset, loader_opts)
 
-    def boundary_loss(self, u, u_tau, u_x, u_xx) -> list[torch.Tensor]:
+    def derivative_plan(self) -> list:
         """
             Instead of computing the lower boundary using the boundary condition, we use the solution of the i-1th asset case, which is already computed,
-            so we only calculated the upper boundary and the mse of the bottom boundary.
+            so the bottom boundary only needs u.
         """
-        losses = torch.zeros(
-            self.n_assets*2, dtype=self.dtype, device=self.device)
-        for i in range(self.n_assets):
-            mask_top_i = self.mask[:, 2 + 2*i].bool()
-            mask_bottom_i = self.mask[:, 3 + 2*i].bool()
-
-            # Bottom boundary
-            if mask_bottom_i.sum() > 0:
-                br = self.y[mask_bottom_i] - u[mask_bottom_i]
-                losses[2*i] = br.square().mean()
+        n = self.n_assets
+        plan = super().derivative_plan()[:2]
+        for i in range(n):
+            plan.append((2 + 2*i, 2 + 2*i, 2, [j for j in range(n) if j != i]))
+            plan.append((3 + 2*i, 3 + 2*i, 0, None))
+        return plan
 
-            # Top boundary
-            if mask_top_i.sum() > 0:
-                tr = self.__top_i_boundary_residual(
-                    u[mask_top_i],
-                    u_tau[mask_top_i],
-                    u_x[mask_top_i],
-                    u_xx[mask_top_i],
-                    i
-                )
-                losses[2*i + 1] = tr.square().mean()
-        return losses
+    def class_residual(self, c, u, u_tau=None, u_x=None, u_xx=None) -> torch.Tensor:
+        if c >= 2 and c % 2 == 1:
+            return self.y[self.class_slice(c)] - u
+        return super().class_residual(c, u, u_tau, u_x, u_xx)
 
 
 class FOPINNClosure(DimlessBS):
@@ -448,79 +813,33 @@ class FOPINNClosure(DimlessBS):
         super().__init__()
 
     def compute_derivatives(self, x):
-        # make x a true leaf
-        x = x.requires_grad_(True)                # [B, n_assets+1]
-        out = self.model(x)                       # [B, 1 + n_assets]
-        u, u_hat = out[:, :1], out[:, 1:]
-
-        # 1) true first‐order gradients (space + time)
-        grads = torch.autograd.grad(
-            u.sum(),
-            x,
-            create_graph=True,
-            retain_graph=True,           # <<< keep the graph alive
-        )[0]                                # [B, n_assets+1]
-        u_x_true = grads[:, :self.n_assets]
-        u_tau_true = grads[:, self.n_assets]
-
-        # 2) predicted first‐order
-        u_x_hat = u_hat[:, :self.n_assets]
-        u_tau_hat = u_hat[:, self.n_assets]
-
-        # 3) second spatial derivatives
-        u_xx_list = []
-        for i in range(self.n_assets):
-            yi = u_x_hat[:, i].sum()
-            full_grad = torch.autograd.grad(
-                yi,
-                x,
-                create_graph=True,
-                retain_graph=True,       # <<< keep the graph alive until final backward
-            )[0]                        # [B, n_assets+1]
-            u_xx_list.append(full_grad[:, :self.n_assets])
-
-        u_xx = torch.stack(u_xx_list, dim=1)  # [B, n_assets, n_assets]
-        return u, u_tau_hat, u_x_hat, u_xx, u_tau_true, u_x_true
-
-    def compute_losses(self):
-        # get all six pieces
-        u, u_tau_hat, u_x_hat, u_xx, u_tau_true, u_x_true = \
-            self.compute_derivatives(self.x)
+        """
+            Computes u, the predicted first derivatives (auxiliary outputs), their Jacobian u_xx and the
+            true first derivatives of u. The Jacobian of all outputs is built in one vectorized reverse
+            pass (vmap of jacrev): its first row is the gradient of u used by the compatibility loss and
+            the rows of the predicted u_x give u_xx.
+        """
+        n = self.n_assets
 
-        # 1) compatibility MSE between predicted vs true first‐derivs
-        comp_time = (u_tau_hat - u_tau_true).square().mean()
-        comp_space = (u_x_hat - u_x_true).square().mean()
-        compatibility = comp_time + comp_space
+        def outputs(x_i):
+            out = self.model(x_i.unsqueeze(0)).squeeze(0)
+            return out, out
 
-        # 2) interior PDE loss (same as before, but using u_tau_hat & u_x_hat & u_xx)
-        interior_mask = self.mask[:, 0].bool()
-        if interior_mask.any():
-            R = self.interior_residual(
-                u[interior_mask],
-                u_tau_hat[interior_mask],
-                u_x_hat[interior_mask],
-                u_xx[interior_mask]
-            )
-            interior_loss = R.square().mean()
-        else:
-            interior_loss = torch.tensor(0., device=u.device)
+        jac, out = vmap(jacrev(outputs, has_aux=True))(x)  # [B, 2+n, 1+n], [B, 2+n]
 
-        # 3) initial‐condition loss
-        init_mask = self.mask[:, 1].bool()
-        if init_mask.any():
-            I = self.initial_residual(
-                u[init_mask],
-                self.y[init_mask]
-            ).square().mean()
-        else:
-            I = torch.tensor(0., device=u.device)
+        # true first-order gradients (space + time)
+        u_x_true = jac[:, 0, :n]
+        u_tau_true = jac[:, 0, n]
 
-        # 4) boundary losses (unchanged)
-        B_losses = self.boundary_loss(
-            u, u_tau_hat, u_x_hat, u_xx
-        )
+        # predicted first-order
+        u, u_hat = out[:, :1], out[:, 1:]
+        u_x_hat = u_hat[:, :n]
+        u_tau_hat = u_hat[:, n]
 
-        return interior_loss, B_losses, I, compatibility
+        # second spatial derivatives, u_xx[:, i, j] = d u_x_hat_i / d x_j
+        u_xx = jac[:, 1:1 + n, :n]
+        self.observe(u=u, u_tau=u_tau_hat, u_x=u_x_hat, u_xx=u_xx)
+        return u, u_tau_hat, u_x_hat, u_xx, u_tau_true, u_x_true
 
     def compute_losses(self):
         # get all six pieces
@@ -533,24 +852,24 @@ class FOPINNClosure(DimlessBS):
         compatibility = comp_time + comp_space
 
         # 2) interior PDE loss (same as before, but using u_tau_hat & u_x_hat & u_xx)
-        interior_mask = self.mask[:, 0].bool()
-        if interior_mask.any():
+        interior = self.class_slice(0)
+        if self.class_count(0) > 0:
             R = self.interior_residual(
-                u[interior_mask],
-                u_tau_hat[interior_mask],
-                u_x_hat[interior_mask],
-                u_xx[interior_mask]
+                u[interior],
+                u_tau_hat[interior],
+                u_x_hat[interior],
+                u_xx[interior]
             )
             interior_loss = R.square().mean()
         else:
             interior_loss = torch.tensor(0., device=u.device)
 
         # 3) initial‐condition loss
-        init_mask = self.mask[:, 1].bool()
-        if init_mask.any():
+        initial = self.class_slice(1)
+        if self.class_count(1) > 0:
             I = self.initial_residual(
-                u[init_mask],
-                self.y[init_mask]
+                u[initial],
+                self.y[initial]
             ).square().mean()
         else:
             I = torch.tensor(0., device=u.device)
@@ -584,116 +903,201 @@ class DimlessBSOnlyInterior(DimlessBS):
     def __init__(self):
         super().__init__()
 
-    def compute_losses(self):
+    def derivative_plan(self) -> list:
         """
-            The training step. Computes all losses and returns the total.
+            Only the interior and initial condition points are used, the boundary losses stay at zero.
         """
-        # self.optimizer.zero_grad()
-        u, u_tau, u_x, u_xx = self.compute_derivatives(self.x)
-
-        # PDE residual: interi or loss
-        interior_mask = self.mask[:, 0].bool()
-        if interior_mask.sum() > 0:
-            interior_loss = self.interior_residual(
-                u[interior_mask],
-                u_tau[interior_mask],
-                u_x[interior_mask],
-                u_xx[interior_mask]
-            ).square().mean()
-        else:
-            interior_loss = torch.tensor(
-                0.0, dtype=self.dtype, device=self.device)
-
-        # Initial condition loss
-        initial_mask = self.mask[:, 1].bool()
-        if initial_mask.sum() > 0:
-            initial_loss = self.initial_residual(
-                u[initial_mask],
-                self.y[initial_mask]
-            ).square().mean()
-        else:
-            initial_loss = torch.tensor(
-                0.0, dtype=self.dtype, device=self.device)
-
-        # to fill the gap so all still works
-        boundary_losses = torch.zeros(
-            self.n_assets*2, dtype=self.dtype, device=self.device)
-        return interior_loss, boundary_losses, initial_loss
+        return super().derivative_plan()[:2]
 
 
-class RBABSOnlyInterior(DimlessBS):
+class RBABSOnlyInterior(ResidualBasedAdaptiveSamplingDimlessBS):
     """
         Mix of residual-based adaptive sampling and only interior loss.
     """
 
-    def __init__(self,  sampler='Halton', k=1, c=1, seed=None):
-        super().__init__()
+    def derivative_plan(self) -> list:
+        """
+            Only the interior and initial condition points are used, the boundary losses stay at zero.
+        """
+        return super().derivative_plan()[:2]
 
-        self.sampler = sampler
-        self.seed = seed
-        self.k = k
-        self.c = c
 
-    def next_batch(self):
-        # Get the next batch of data
-        super().next_batch()
+class ForwardLaplacianDimlessBS(DimlessBS):
+    """
+        Training step of the non-dimensional Black-Scholes PDE where the diffusion term tr(A H), with
+        A = 1/2 diag(sigma) rho diag(sigma), comes from a forward Laplacian sweep through the network
+        (nn.forward_jet) instead of a u_xx built with a second-order autograd tape.
 
-        interior_mask = self.mask[:, 0].bool()
-        n_samples = self.x[interior_mask].shape[0]
-
-        def res_f(x):
-            x = torch.tensor(x, dtype=self.dtype,
-                             device=self.device)
-            u, u_tau, u_x, u_xx = self.compute_derivatives(x)
-            return self.interior_residual(u, u_tau, u_x, u_xx).detach().cpu().numpy()
-
-        tmp_x = residual_based_adaptive_sampling(
-            res_f,
-            n_samples,
-            self.dataset.params.domain_ranges(),
-            k=self.k,
-            c=self.c,
-            sampler=self.sampler,
-            seed=self.seed
-        )
-        # we need to modify the tmp_x to be in the same range as the original x
-        tmp_x = torch.tensor(tmp_x, dtype=self.dtype,
-                             device=self.device)
+        Each point class propagates the factor of its own operator (interior: A, boundaries of asset i:
+        A without row and column i), so a single sweep serves the whole batch.
+    """
 
-        self.x[interior_mask] = tmp_x
+    def __init__(self):
+        super().__init__()
+        self.directions = None
+        self.weights = None
 
-    def compute_losses(self):
+    def with_dataset(self, dataset: SampledDataset, loader_opts: dict):
+        super().with_dataset(dataset, loader_opts)
+        self.directions, self.weights = self.class_directions()
+        return self
+
+    def class_directions(self):
         """
-            The training step. Computes all losses and returns the total.
+            Directions V_c of shape [n_assets + 1, K] (zero time row) and weights w_c such that
+            tr(A_c H) = sum_k w_ck v_ck^T H v_ck. Here V_c is the symmetric square-root factor of A_c.
         """
-        # self.optimizer.zero_grad()
-        u, u_tau, u_x, u_xx = self.compute_derivatives(self.x)
-
-        # PDE residual: interi or loss
-        interior_mask = self.mask[:, 0].bool()
-        if interior_mask.sum() > 0:
-            interior_loss = self.interior_residual(
-                u[interior_mask],
-                u_tau[interior_mask],
-                u_x[interior_mask],
-                u_xx[interior_mask]
-            ).square().mean()
-        else:
-            interior_loss = torch.tensor(
-                0.0, dtype=self.dtype, device=self.device)
-
-        # Initial condition loss
-        initial_mask = self.mask[:, 1].bool()
-        if initial_mask.sum() > 0:
-            initial_loss = self.initial_residual(
-                u[initial_mask],
-                self.y[initial_mask]
-            ).square().mean()
+        n = self.n_assets
+        evals, evecs = torch.linalg.eigh(self.diffusion_coefs)
+        directions = torch.zeros(
+            evecs.shape[0], n + 1, n, dtype=evecs.dtype, device=evecs.device)
+        directions[:, :n, :] = evecs * evals.clamp(min=0).sqrt().unsqueeze(1)
+        weights = torch.ones_like(evals)
+        return directions, weights
+
+    def directional_derivatives(self, x, directions) -> tuple:
+        """
+            Computes u, u_tau, u_x and the second derivatives along each direction [B, d, K] in one sweep.
+        """
+        if supports_forward_jet(self.model):
+            u, jac, d2 = forward_jet(self.model, x, directions)
         else:
-            initial_loss = torch.tensor(
-                0.0, dtype=self.dtype, device=self.device)
+            u, jac, d2 = jvp_jet(self.model, x, directions)
+        return u, jac[:, 0, -1], jac[:, 0, :self.n_assets], d2[:, 0]
 
-        # to fill the gap so all still works
-        boundary_losses = torch.zeros(
-            self.n_assets*2, dtype=self.dtype, device=self.device)
-        return interior_loss, boundary_losses, initial_loss
+    def compute_derivatives(self, x, classes=None, dims=None) -> tuple:
+        """
+            Computes u, u_tau, u_x and the diffusion term of each point's class in one forward sweep.
+            Points without a class are treated as interior points. dims is not needed, the class directions
+            already exclude the fixed asset of each boundary.
+        """
+        if classes is None:
+            classes = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+        u, u_tau, u_x, d2 = self.directional_derivatives(
+            x, self.directions[classes])
+        diffusion = (d2 * self.weights[classes]).sum(1)
+        self.observe(u=u, u_tau=u_tau, u_x=u_x, diffusion=diffusion)
+        return u, u_tau, u_x, diffusion
+
+    def diffusion_term(self, diffusion, classes) -> torch.Tensor:
+        """
+            The diffusion term is already contracted by compute_derivatives.
+        """
+        return diffusion
+
+
+class HutchinsonDimlessBS(ForwardLaplacianDimlessBS):
+    """
+        Stochastic variant of ForwardLaplacianDimlessBS for large baskets. The diffusion term tr(A_c H) is
+        estimated from n_probes random directions v = V_c z with E[z z^T] = I, so the cost and memory of the
+        second-order part scale with n_probes instead of n_assets.
+
+        - distribution: "rademacher" or "gaussian" probes.
+        - mode: "taylor" propagates the probes forward (nn.forward_jet / jvp_jet), "hvp" uses one batched
+          Hessian-vector product.
+
+        The batch mean of the estimator variance is stored in state["probe_variance"].
+    """
+
+    def __init__(self, n_probes=8, distribution="rademacher", mode="taylor", seed=None):
+        super().__init__()
+        if distribution not in ["rademacher", "gaussian"]:
+            raise ValueError(f"Invalid probe distribution: {distribution}")
+        if mode not in ["taylor", "hvp"]:
+            raise ValueError(f"Invalid mode: {mode}")
+        if n_probes < 2:
+            raise ValueError(f"Invalid number of probes: {n_probes}")
+
+        self.n_probes = n_probes
+        self.distribution = distribution
+        self.mode = mode
+        self.seed = seed
+        self.generator = None
+        self.probe_variance = []
+        self.state["probe_variance"] = []
+
+    def with_dataset(self, dataset: SampledDataset, loader_opts: dict):
+        super().with_dataset(dataset, loader_opts)
+        self.generator = torch_generator(self.seed, dataset.device)
+        return self
+
+    def sample_probes(self, n_points, dtype, device):
+        """
+            Returns probes z [n_points, n_assets, n_probes].
+        """
+        n, K = self.n_assets, self.n_probes
+        opts = dict(dtype=dtype, device=device, generator=self.generator)
+        if self.distribution == "rademacher":
+            return torch.randint(0, 2, (n_points, n, K), **opts) * 2 - 1
+        return torch.randn(n_points, n, K, **opts)
+
+    def directional_derivatives(self, x, directions) -> tuple:
+        if self.mode == "taylor":
+            return super().directional_derivatives(x, directions)
+        # one copy of the batch per probe, so a single double-backward serves all probes
+        B, K = x.shape[0], directions.shape[-1]
+        x_rep = x.detach().repeat(K, 1).requires_grad_(True)
+        tangents = directions.permute(2, 0, 1).reshape(K * B, -1)
+        u = self.model(x_rep)
+        grads = torch.autograd.grad(u.sum(), x_rep, create_graph=True)[0]
+        hv = torch.autograd.grad(
+            (grads * tangents).sum(), x_rep, create_graph=True)[0]
+        d2 = (hv * tangents).sum(-1).view(K, B).T
+        return u[:B], grads[:B, -1], grads[:B, :self.n_assets], d2
+
+    def compute_derivatives(self, x, classes=None, dims=None) -> tuple:
+        """
+            Computes u, u_tau, u_x and an unbiased estimate of the diffusion term of each point's class.
+        """
+        if classes is None:
+            classes = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+        z = self.sample_probes(x.shape[0], x.dtype, x.device)
+        u, u_tau, u_x, d2 = self.directional_derivatives(
+            x, self.directions[classes] @ z)
+
+        diffusion = d2.mean(1)
+        with torch.no_grad():
+            self.probe_variance.append(d2.var(1) / d2.shape[1])
+        self.observe(u=u, u_tau=u_tau, u_x=u_x, diffusion=diffusion)
+        return u, u_tau, u_x, diffusion
+
+    def __call__(self, *args, **kwargs):
+        self.probe_variance = []
+        loss = super().__call__(*args, **kwargs)
+        if kwargs.get('update_status', True):
+            self.state["probe_variance"].append(
+                torch.cat(self.probe_variance).mean().item())
+        return loss
+
+
+class EigenDirectionalDimlessBS(ForwardLaplacianDimlessBS):
+    """
+        Computes the diffusion term from second derivatives along the eigenvectors of each class's
+        diffusion matrix, tr(A_c H) = sum_k lambda_ck q_ck^T H q_ck, using forward-over-forward
+        propagation. The eigen-decomposition is done once in with_dataset and eigen-directions with
+        lambda < tol * lambda_max are dropped (optionally capped at max_rank), so correlated baskets with
+        a low-rank rho need fewer directions than assets.
+    """
+
+    def __init__(self, tol=1e-6, max_rank=None):
+        super().__init__()
+        self.tol = tol
+        self.max_rank = max_rank
+        self.rank = None
+
+    def class_directions(self):
+        n = self.n_assets
+        evals, evecs = torch.linalg.eigh(self.diffusion_coefs)
+        evals, evecs = evals.flip(-1), evecs.flip(-1)
+
+        keep = evals > self.tol * evals.max()
+        if self.max_rank is not None:
+            keep[:, self.max_rank:] = False
+        self.rank = max(int(keep.sum(1).max()), 1)
+
+        keep = keep[:, :self.rank]
+        directions = torch.zeros(
+            evecs.shape[0], n + 1, self.rank, dtype=evecs.dtype, device=evecs.device)
+        directions[:, :n, :] = evecs[:, :, :self.rank] * keep.unsqueeze(1)
+        weights = evals[:, :self.rank] * keep
+        return directions, weights
@@ -1,5 +1,12 @@
 import numpy as np
-from derpinns.sampling import random_samples, scale_samples
+import torch
+import hashlib
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from derpinns.sampling import random_samples, scale_samples, spawn_seeds, as_sparse_grid
 
 
 class OptionParameters:
@@ -35,116 +42,186 @@ class OptionParameters:
 
 def payoff(x):
     # Compute the option payoff (example: a call on the maximum of assets).
+    if isinstance(x, torch.Tensor):
+        # keeps points generated on the device there
+        x = torch.exp(x).max(dim=1).values
+        return torch.clamp(x - 1, min=0).reshape([-1, 1])
     x = np.max(np.exp(x), axis=1)
     payoff_values = np.maximum(x - 1, 0)
     return payoff_values.reshape([-1, 1])
 
 
-def generate_collocations(n_samples, params: OptionParameters, mask_col, initial_condition=False,
-                          fixed_asset_id=None, fixed_asset_value=None, sampler='pseudo', seed=None):
+def class_counts(params: OptionParameters, interior_samples, initial_samples, boundary_samples):
     '''
-    Generates collocation points, their labels, and a binary mask.
-
-    The mask is a matrix of shape (n_samples, num_loss_types) where:
-         num_loss_types = 2 + 2 * params.n_assets.
-
-    The mask column is specified by mask_col:
+    Number of points of every class, indexed by label:
          - 0 for interior collocations.
          - 1 for initial condition collocations.
          - For asset boundaries:
-               top boundary for asset i: mask_col = 2 + 2*i 
-               bottom boundary for asset i: mask_col = 2 + 2*i + 1
+               top boundary for asset i: label = 2 + 2*i
+               bottom boundary for asset i: label = 2 + 2*i + 1
     '''
-    samples = random_samples(n_samples, params.n_dim, sampler, seed=seed)
+    return [interior_samples, initial_samples] + [boundary_samples] * (2 * params.n_assets)
+
 
-    if initial_condition:
+def class_ranges(params: OptionParameters, label):
+    '''
+    Domain of the collocation points of the given class (see class_counts for the labels).
+    '''
+    if label == 0:
+        return params.domain_ranges()
+    if label == 1:
         # For the initial condition, time is 0.
-        ranges = params.domain_ranges(tau=0)
-        x = scale_samples(samples, ranges)
-        y = params.payoff(x)
-    elif fixed_asset_id is not None:
-        # For boundary conditions, fix one asset variable.
-        ranges = params.domain_ranges(fixed_asset_id=fixed_asset_id,
-                                      fixed_asset_value=fixed_asset_value)
-        x = scale_samples(samples, ranges)
-        y = np.zeros((n_samples, 1))
+        return params.domain_ranges(tau=0)
+    # For boundary conditions, fix one asset variable.
+    asset, bottom = divmod(label - 2, 2)
+    return params.domain_ranges(fixed_asset_id=asset,
+                                fixed_asset_value=params.x_min if bottom else params.x_max)
+
+
+def class_samples(n_samples, ranges, sampler='pseudo', seed=None):
+    '''
+    Samples in the unit box for a class with the given domain ranges. Sparse grids are only built over the free
+    coordinates, as the fixed ones would make grid points collapse onto each other.
+    '''
+    sparse_grid = as_sparse_grid(sampler)
+    if sparse_grid is None:
+        return random_samples(n_samples, len(ranges), sampler, seed=seed)
+    free = [j for j, (low, high) in enumerate(ranges) if high > low]
+    weights = sparse_grid.weights(len(ranges))
+    samples = np.zeros((n_samples, len(ranges)))
+    samples[:, free] = sparse_grid.sample(n_samples, [weights[j] for j in free])
+    return samples
+
+
+def generate_collocations(n_samples, params: OptionParameters, label, sampler='pseudo', seed=None):
+    '''
+    Generates collocation points of the class with the given label (see class_counts).
+    '''
+    ranges = class_ranges(params, label)
+    return scale_samples(class_samples(n_samples, ranges, sampler, seed), ranges)
+
+
+def generate_collocations_into(buffer_name, shape, start, n_samples, ranges, sampler='pseudo', seed=None):
+    '''
+    Writes the collocation points of one class into rows [start, start + n_samples) of a shared memory buffer.
+    Used by the worker processes of generate_dataset.
+    '''
+    buffer = SharedMemory(name=buffer_name)
+    try:
+        x = np.ndarray(shape, dtype=np.float64, buffer=buffer.buf)
+        x[start:start + n_samples] = scale_samples(
+            class_samples(n_samples, ranges, sampler, seed), ranges)
+        del x
+    finally:
+        buffer.close()
+
+
+def generate_dataset(params: OptionParameters, interior_samples, initial_samples, boundary_samples, sampler='pseudo', seed=None, workers=None):
+    '''
+        Generates all the samples required to train the PINN (interior, initial condition, top and bottom samples),
+        written class by class into a single preallocated array, so the points are sorted by label.
+
+        Every class gets its own random stream spawned from seed, so the classes are independent and each one is
+        reproducible. With workers > 1 the classes are generated by a process pool writing into a shared buffer,
+        and the result does not depend on workers.
+
+        Returns the points, the targets of the initial condition points only (the payoff) and one int8 label per point.
+    '''
+    counts = class_counts(params, interior_samples,
+                          initial_samples, boundary_samples)
+    shape = (sum(counts), params.n_dim)
+    labels = np.repeat(np.arange(len(counts), dtype=np.int8), counts)
+    starts = np.cumsum([0] + counts[:-1]).tolist()
+    seeds = spawn_seeds(seed, len(counts))
+    classes = [(label, start, n_samples) for label, (start, n_samples)
+               in enumerate(zip(starts, counts)) if n_samples > 0]
+
+    if workers is None or workers <= 1:
+        x = np.empty(shape)
+        for label, start, n_samples in classes:
+            x[start:start + n_samples] = generate_collocations(
+                n_samples, params, label, sampler=sampler, seed=seeds[label])
     else:
-        ranges = params.domain_ranges()
-        x = scale_samples(samples, ranges)
-        y = np.zeros((n_samples, 1))
-
-    num_loss_types = 2 + 2 * params.n_assets
-    mask = np.zeros((n_samples, num_loss_types), dtype=int)
-    mask[:, mask_col] = 1
-
-    return x, y, mask
-
-
-def concat_datasets(dataset1, dataset2):
-    '''
-    Concatenates two datasets. Each dataset is a tuple (x, y, mask).
-    '''
-    x1, y1, mask1 = dataset1
-    x2, y2, mask2 = dataset2
-    x = np.concatenate((x1, x2), axis=0)
-    y = np.concatenate((y1, y2), axis=0)
-    mask = np.concatenate((mask1, mask2), axis=0)
-    return x, y, mask
-
-
-def generate_dataset(params: OptionParameters, interior_samples, initial_samples, boundary_samples, sampler='pseudo', seed=None):
-    '''
-        Generates all the samples required to train the PINN (top, bottom, initial condition and interior samples).
-    '''
-    # Generate interior collocations (mask column 0).
-    interior_points = generate_collocations(
-        n_samples=interior_samples,
-        params=params,
-        mask_col=0,
-        sampler=sampler,
-        seed=seed
-    )
-
-    # Generate initial condition collocations (mask column 1) with time t = 0.
-    initial_condition_points = generate_collocations(
-        n_samples=initial_samples,
-        params=params,
-        mask_col=1,
-        initial_condition=True,
-        sampler=sampler,
-        seed=seed
-    )
-
-    dataset = concat_datasets(interior_points, initial_condition_points)
-
-    if boundary_samples > 0:
-        for i in range(params.n_assets):
-            # Top boundary for asset i (mask column 2 + 2*i).
-            top_boundary_points = generate_collocations(
-                n_samples=boundary_samples,
-                params=params,
-                mask_col=2 + 2 * i,
-                fixed_asset_id=i,
-                fixed_asset_value=params.x_max,
-                sampler=sampler,
-                seed=seed
-            )
-            # Bottom boundary for asset i (mask column 2 + 2*i + 1).
-            bottom_boundary_points = generate_collocations(
-                n_samples=boundary_samples,
-                params=params,
-                mask_col=2 + 2 * i + 1,
-                fixed_asset_id=i,
-                fixed_asset_value=params.x_min,
-                sampler=sampler,
-                seed=seed
-            )
-
-            dataset = concat_datasets(dataset, top_boundary_points)
-            dataset = concat_datasets(dataset, bottom_boundary_points)
-
-    x, y, mask = dataset
-    return x, y, mask
+        buffer = SharedMemory(create=True, size=max(
+            int(np.prod(shape)) * 8, 1))
+        try:
+            # the domain ranges are sent instead of params, the payoff may not be picklable
+            with ProcessPoolExecutor(workers) as pool:
+                futures = [pool.submit(generate_collocations_into, buffer.name, shape, start, n_samples,
+                                       class_ranges(params, label), sampler, seeds[label])
+                           for label, start, n_samples in classes]
+                for future in futures:
+                    future.result()
+            shared = np.ndarray(shape, dtype=np.float64, buffer=buffer.buf)
+            x = shared.copy()
+            del shared
+        finally:
+            buffer.close()
+            buffer.unlink()
+
+    y = params.payoff(x[interior_samples:interior_samples + initial_samples])
+    return x, y, labels
+
+
+CACHE_VERSION = 3
+
+
+def seed_key(seed):
+    '''
+        Stable representation of a seed for dataset_key. SeedSequences are keyed by their entropy and spawn key,
+        Generators are stateful and cannot identify a dataset.
+    '''
+    if isinstance(seed, np.random.SeedSequence):
+        return f"SeedSequence({seed.entropy}, {seed.spawn_key}, {seed.pool_size})"
+    if isinstance(seed, (np.random.Generator, np.random.BitGenerator)):
+        raise ValueError("Datasets seeded with a Generator cannot be cached, use an int or a SeedSequence")
+    return seed
+
+
+def dataset_key(params: OptionParameters, interior_samples, initial_samples, boundary_samples, sampler, seed):
+    '''
+        Content hash of everything that determines the points of a generated dataset. The payoff is not part of
+        it, the targets are never cached.
+    '''
+    h = hashlib.sha256()
+    values = [CACHE_VERSION, params.n_assets, params.tau, params.sigma, params.rho, params.r, params.strike,
+              params.x_min, params.x_max, interior_samples, initial_samples, boundary_samples, str(sampler), seed_key(seed)]
+    for value in values:
+        value = np.asarray(value)
+        h.update(f"{value.dtype}{value.shape}".encode())
+        h.update(value.tobytes())
+    return h.hexdigest()
+
+
+def cached_dataset(params: OptionParameters, interior_samples, initial_samples, boundary_samples, sampler='pseudo', seed=None, cache_dir=None, mmap_mode='r', workers=None):
+    '''
+        Same as generate_dataset, but the points and labels are stored as .npy files under cache_dir, keyed by
+        dataset_key, and later calls load them memory-mapped (mmap_mode) instead of regenerating. The targets
+        are recomputed from params.payoff on every call, so a payoff can never be identified wrongly. Datasets
+        without a seed are not reproducible, so they are never cached.
+    '''
+    if seed is None or cache_dir is None:
+        return generate_dataset(params, interior_samples, initial_samples, boundary_samples, sampler, seed, workers)
+
+    path = os.path.join(cache_dir, dataset_key(
+        params, interior_samples, initial_samples, boundary_samples, sampler, seed))
+    names = ("x", "labels")
+    if not os.path.isdir(path):
+        x, _, labels = generate_dataset(
+            params, interior_samples, initial_samples, boundary_samples, sampler, seed, workers)
+        os.makedirs(cache_dir, exist_ok=True)
+        # write into a temporary directory and rename it, so readers never see partial files
+        tmp = tempfile.mkdtemp(dir=cache_dir)
+        for name, array in zip(names, (x, labels)):
+            np.save(os.path.join(tmp, name + ".npy"), array)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # written concurrently by another process
+            shutil.rmtree(tmp)
+    x, labels = (np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in names)
+    y = params.payoff(x[interior_samples:interior_samples + initial_samples])
+    return x, y, labels
 
 
 if __name__ == "__main__":
@@ -161,18 +238,17 @@ if __name__ == "__main__":
     strike = 60
 
     params = OptionParameters(n_assets, tau, sigma, rho, r, strike, payoff)
-    x, y, mask = generate_dataset(params, interior_samples=interior_samples,
-                                  initial_samples=initial_samples, boundary_samples=boundary_samples, sampler='Halton')
+    x, y, labels = generate_dataset(params, interior_samples=interior_samples,
+                                    initial_samples=initial_samples, boundary_samples=boundary_samples, sampler='Halton')
 
     print("Generated dataset:")
     print("x:", x.shape)
     print("y:", y.shape)
-    print("mask:", mask.shape)
-    # Optionally, print a few rows of the mask.
-    print("Sample mask rows:")
-    print(mask[:, 1])
-    interior_mask = mask[:, 0] == 1
-    interior_points = x[interior_mask]
-    print(interior_mask, interior_points)
+    print("labels:", labels.shape)
+    # Optionally, print the number of points of each class.
+    print("Class counts:")
+    print(np.bincount(labels))
+    interior_points = x[labels == 0]
+    print(interior_points)
     plt.scatter(interior_points[:, 0], interior_points[:, 1])
     plt.show()
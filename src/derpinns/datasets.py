@@ -1,44 +1,222 @@
 from torch import nn
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from derpinns.collocations import *
+from derpinns.sampling import spawn_seeds, torch_generator
+
+
+class ClassSortedBatchSampler:
+    """
+        Batch sampler over a dataset whose points are stored sorted by class. Every batch is returned
+        sorted by class together with the number of points of each class, so the closures can reduce the
+        losses over contiguous slices.
+
+        The permutation, the per-batch sort and the class counts of a whole epoch are computed on the
+        labels' device at the start of the epoch, so the only host sync is one transfer of the counts per
+        epoch. A seed gives the shuffling its own generator instead of the global torch one.
+    """
+
+    def __init__(self, labels: torch.Tensor, n_classes: int, batch_size: int, shuffle: bool = False, seed=None):
+        self.labels = labels
+        self.n_classes = n_classes
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.generator = torch_generator(seed, labels.device) if shuffle and seed is not None else None
+
+    def __len__(self):
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.labels)
+        device = self.labels.device
+        order = torch.randperm(n, generator=self.generator, device=device) if self.shuffle \
+            else torch.arange(n, device=device)
+
+        # the dataset is class-sorted, so sorting the indices sorts each batch by class
+        n_full = n // self.batch_size * self.batch_size
+        full = order[:n_full].view(-1, self.batch_size).sort(1).values
+        labels = self.labels[full].long()
+        counts = torch.zeros(full.shape[0], self.n_classes, dtype=torch.long, device=device)\
+            .scatter_add_(1, labels, torch.ones_like(labels))
+        batches = list(full)
+        if n_full < n:
+            batches.append(order[n_full:].sort().values)
+            counts = torch.cat([counts, torch.bincount(
+                self.labels[batches[-1]], minlength=self.n_classes).unsqueeze(0)])
+        yield from zip(batches, counts.tolist())
+
+
+class StratifiedClassBatchSampler:
+    """
+        Batch sampler with the same number of points of every class in all batches. Each class is walked
+        through in its own order on the labels' device, restarted when exhausted, so batches never shrink
+        and the batch shape and class offsets are static (as needed by torch.compile).
+
+        quotas sets the batch composition as relative weights, either one per class (label) or a
+        dict with "interior", "initial" and "boundary" (split evenly among the faces). By default the
+        composition follows the class sizes of the dataset. Every class with a positive quota gets at
+        least one point and at most its size, so a batch never repeats a point. A seed gives the shuffling
+        its own generator.
+    """
+
+    def __init__(self, labels: torch.Tensor, n_classes: int, batch_size: int, shuffle: bool = False, quotas=None, seed=None):
+        self.labels = labels
+        self.n_classes = n_classes
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.generator = torch_generator(seed, labels.device) if shuffle and seed is not None else None
+
+        self.sizes = torch.bincount(labels, minlength=n_classes).cpu()
+        self.starts = (torch.cumsum(self.sizes, 0) - self.sizes).tolist()
+        self.quotas = self.class_quotas(quotas)
+        self.counts = self.class_counts(self.quotas, batch_size, self.sizes)
+        self.orders = [self.class_order(c) for c in range(n_classes)]
+        self.cursors = [0] * n_classes
+
+    def class_quotas(self, quotas) -> torch.Tensor:
+        """
+            Relative weight of every class in the batch.
+        """
+        if quotas is None:
+            return self.sizes.double()
+        if isinstance(quotas, dict):
+            n_faces = self.n_classes - 2
+            weights = [quotas.get("interior", 0.0), quotas.get("initial", 0.0)] + \
+                [quotas.get("boundary", 0.0) / n_faces] * n_faces
+        else:
+            weights = list(quotas)
+        if len(weights) != self.n_classes or min(weights) < 0 or sum(weights) <= 0:
+            raise ValueError("Invalid quotas")
+        return torch.tensor(weights, dtype=torch.float64) * (self.sizes > 0)
+
+    @staticmethod
+    def class_counts(quotas: torch.Tensor, batch_size: int, sizes: torch.Tensor = None) -> list:
+        """
+            Splits the batch size among the classes following the quotas (largest remainders). No class
+            gets more points than its size, so points never repeat within a batch (the batch is smaller
+            than batch_size if the dataset is), and every class with a positive quota gets at least one.
+        """
+        active = quotas > 0
+        if batch_size < int(active.sum()):
+            raise ValueError(
+                f"batch_size {batch_size} is smaller than the number of classes ({int(active.sum())})")
+        sizes = torch.full_like(quotas, float("inf")) if sizes is None else sizes.double()
+        counts = torch.zeros_like(quotas)
+        budget = min(float(batch_size), float(sizes[active].sum()))
+        # every pass shares what is left among the classes with room, the full ones drop out
+        while counts.sum() < budget:
+            weights = quotas * (counts < sizes)
+            left = budget - float(counts.sum())
+            share = weights * left / weights.sum()
+            add = share.floor()
+            add[(share - add).argsort(descending=True)[:int(left - add.sum())]] += 1
+            counts += torch.minimum(add, sizes - counts)
+        for c in (active & (counts == 0)).nonzero().flatten():
+            counts[counts.argmax()] -= 1
+            counts[c] = 1
+        return counts.long().tolist()
+
+    def class_order(self, c) -> torch.Tensor:
+        size = int(self.sizes[c])
+        device = self.labels.device
+        order = torch.randperm(size, generator=self.generator, device=device) if self.shuffle \
+            else torch.arange(size, device=device)
+        return self.starts[c] + order
+
+    def take(self, c, k) -> torch.Tensor:
+        if self.cursors[c] + k > len(self.orders[c]):
+            # the class runs out within this batch: its rest is completed from the next epoch's order, with
+            # the points of the rest moved to the back of that order so the batch does not repeat them
+            rest = self.orders[c][self.cursors[c]:]
+            order = self.class_order(c)
+            seen = torch.isin(order, rest)
+            self.orders[c] = torch.cat([rest, order[~seen], order[seen]])
+            self.cursors[c] = 0
+        idx = self.orders[c][self.cursors[c]:self.cursors[c] + k]
+        self.cursors[c] += k
+        return idx
+
+    def __len__(self):
+        return max(len(self.labels) // self.batch_size, 1)
+
+    def __iter__(self):
+        while True:
+            idx = torch.cat([self.take(c, k)
+                            for c, k in enumerate(self.counts)])
+            yield idx, self.counts
 
 
 class SampledDataset(Dataset):
     """
-        Generates a dataset of collocations points.
+        Generates a dataset of collocations points, stored sorted by class with one int8 label per point.
+        Targets are only kept for the initial condition points.
+
+        With a cache_dir, seeded datasets are cached on disk (see collocations.cached_dataset) and loaded
+        memory-mapped. in_memory=False keeps the points memory-mapped on the host and only moves the rows
+        of each batch to the device, so the dataset may be larger than the available memory. workers > 1
+        generates the classes in parallel processes.
     """
 
-    def __init__(self, params: OptionParameters, interior_samples: int, initial_samples: int, boundary_samples: int, sampler: str, dtype: torch.dtype, device: torch.device, verbose: bool = False, seed=None):
+    def __init__(self, params: OptionParameters, interior_samples: int, initial_samples: int, boundary_samples: int, sampler: str, dtype: torch.dtype, device: torch.device, verbose: bool = False, seed=None, cache_dir=None, in_memory: bool = True, workers=None):
         self.params = params
-        x, y, mask = generate_dataset(
-            params, interior_samples, initial_samples, boundary_samples, sampler, seed)
+        self.dtype = dtype
+        self.device = device
+        self.n_classes = 2 + 2 * params.n_assets
+        # points are generated sorted by class, the batch sampler relies on it
+        x, y, labels = cached_dataset(
+            params, interior_samples, initial_samples, boundary_samples, sampler, seed, cache_dir,
+            workers=workers)
 
-        self.x = torch.tensor(x, dtype=dtype, device=device)
+        if in_memory:
+            self.x = torch.tensor(x, dtype=dtype, device=device)
+        else:
+            self.x = x
         self.y = torch.tensor(y, dtype=dtype, device=device)
-        self.mask = torch.tensor(mask, dtype=torch.bool, device=device)
+        self.labels = torch.tensor(labels, dtype=torch.int8, device=device)
+        self.initial_start = interior_samples
 
         if verbose:
             import matplotlib.pyplot as plt
-            print(self.mask[:, 1])
-            interior_mask = self.mask[:, 0] == 1
-            interior_points = self.x[interior_mask].cpu().detach().numpy()
-            print(interior_mask, interior_points)
+            interior_points = self.points(
+                (self.labels == 0).nonzero().flatten()).cpu().detach().numpy()
+            print(interior_points)
             plt.scatter(interior_points[:, 0], interior_points[:, 1])
             plt.show()
 
             print("Shapes:")
             print(f"x: {self.x.shape}")
             print(f"y: {self.y.shape}")
-            print(f"mask: {self.mask.shape}")
-            for i in range(self.mask.shape[1]):
-                print(f"mask[:, {i}].sum(): {self.mask[:, i].sum().item()}")
+            print(f"labels: {self.labels.shape}")
+            for i, count in enumerate(torch.bincount(self.labels, minlength=self.n_classes).tolist()):
+                print(f"class {i}: {count}")
+
+    def points(self, idx: torch.Tensor) -> torch.Tensor:
+        """
+            Points of the given indices on the device.
+        """
+        if isinstance(self.x, torch.Tensor):
+            return self.x.index_select(0, idx)
+        # memory-mapped points, the batch indices are sorted so the reads are mostly sequential
+        rows = self.x[idx.cpu().numpy()]
+        return torch.as_tensor(rows, dtype=self.dtype).to(self.device, non_blocking=True)
+
+    def targets(self, idx: torch.Tensor) -> torch.Tensor:
+        """
+            Targets of the given points, zero outside the initial condition.
+        """
+        initial = idx - self.initial_start
+        inside = (initial >= 0) & (initial < len(self.y))
+        y = self.y.index_select(0, initial.clamp(0, len(self.y) - 1))
+        return y * inside.unsqueeze(1)
 
     def __len__(self):
         return self.x.shape[0]
 
     def __getitem__(self, idx):
-        return self.x[idx], self.y[idx], self.mask[idx, :]
+        idx = torch.as_tensor(idx, device=self.device)
+        return self.points(idx), self.targets(idx), self.labels[idx]
 
 
 class SampledDatasetWithPINNBoundary(Dataset):
@@ -48,14 +226,20 @@ class SampledDatasetWithPINNBoundary(Dataset):
 
     def __init__(self, pinn: nn.Module, params: OptionParameters, interior_samples: int, initial_samples: int, boundary_samples: int, sampler: str, dtype: torch.dtype, device: torch.device, verbose: bool = False):
         self.params = params
-        x, y, mask = generate_dataset(
+        self.dtype = dtype
+        self.device = device
+        self.n_classes = 2 + 2 * params.n_assets
+        x, y_initial, labels = generate_dataset(
             params, interior_samples, initial_samples, boundary_samples, sampler)
+        # the lower boundaries have targets too, so y covers every point
+        y = np.zeros((len(x), 1))
+        y[labels == 1] = y_initial
 
         # Compute the boundary values using the PINN model
         # for the lower boundary (n-1th asset case)
         for i in range(params.n_assets):
             lb_idx = 2*i + 2
-            lb_mask = self.mask[:, lb_idx]  # lower boundary for the i-th asset
+            lb_mask = labels == lb_idx  # lower boundary for the i-th asset
             lb_x = self.x[lb_mask]
             # remove ith asset from the input
             lb_x = np.cat([lb_x[:, :i], lb_x[:, i+1:]], dim=1)
@@ -68,10 +252,89 @@ class SampledDatasetWithPINNBoundary(Dataset):
             x, dtype=dtype, device=device, requires_grad=True)
 
         self.y = torch.tensor(y, dtype=dtype, device=device)
-        self.mask = torch.tensor(mask, dtype=torch.bool, device=device)
+        self.labels = torch.tensor(labels, dtype=torch.int8, device=device)
+
+    def points(self, idx: torch.Tensor) -> torch.Tensor:
+        return self.x.index_select(0, idx)
+
+    def targets(self, idx: torch.Tensor) -> torch.Tensor:
+        return self.y.index_select(0, idx)
 
     def __len__(self):
         return self.x.shape[0]
 
     def __getitem__(self, idx):
-        return self.x[idx], self.y[idx], self.mask[idx, :]
+        return self.x[idx], self.y[idx], self.labels[idx]
+
+
+class CollocationStream(IterableDataset):
+    """
+        Infinite stream of collocation batches generated directly on the device from the domain of the
+        option parameters, so memory stays constant regardless of how many points are seen. Every batch
+        holds interior_samples interior points, initial_samples initial condition points and
+        boundary_samples points per face, sorted by class.
+
+        The points are redrawn every resample_every steps. With sampler="Sobol" a scrambled Sobol set is
+        drawn once per class and re-randomized by a random shift (modulo 1) instead, which keeps its low
+        discrepancy.
+    """
+
+    def __init__(self, params: OptionParameters, interior_samples: int, initial_samples: int, boundary_samples: int, sampler: str = "pseudo", resample_every: int = 1, dtype: torch.dtype = torch.float32, device: torch.device = torch.device("cpu"), seed=None):
+        if sampler not in ("pseudo", "Sobol"):
+            raise ValueError(f"{sampler} sampling is not available.")
+        if resample_every < 1:
+            raise ValueError("Invalid resample_every")
+        self.params = params
+        self.sampler = sampler
+        self.resample_every = resample_every
+        self.dtype = dtype
+        self.device = device
+
+        self.n_classes = 2 + 2 * params.n_assets
+        self.counts = class_counts(
+            params, interior_samples, initial_samples, boundary_samples)
+        self.labels = torch.repeat_interleave(
+            torch.arange(self.n_classes, device=device),
+            torch.tensor(self.counts, device=device))
+
+        ranges = torch.tensor([class_ranges(params, c) for c in range(self.n_classes)],
+                              dtype=dtype, device=device)[self.labels]
+        self.low = ranges[..., 0]
+        self.span = ranges[..., 1] - ranges[..., 0]
+        self.initial = slice(self.counts[0], self.counts[0] + self.counts[1])
+
+        # one stream for the draws and shifts, one per class for the Sobol base sets
+        shift_seed, *class_seeds = spawn_seeds(seed, 1 + self.n_classes)
+        self.generator = torch_generator(shift_seed, device)
+        self.base = None
+        if sampler == "Sobol":
+            self.base = torch.cat([
+                random_samples(k, params.n_dim, "Sobol", seed=class_seed, dtype=dtype, device=device)
+                for class_seed, k in zip(class_seeds, self.counts)])
+
+        self.steps = 0
+        self.x = None
+        self.y = None
+
+    def uniform(self) -> torch.Tensor:
+        if self.base is None:
+            return torch.rand((len(self.labels), self.params.n_dim), generator=self.generator,
+                              dtype=self.dtype, device=self.device)
+        shift = torch.rand((1, self.params.n_dim), generator=self.generator,
+                           dtype=self.dtype, device=self.device)
+        return torch.remainder(self.base + shift, 1.0)
+
+    def resample(self):
+        self.x = self.low + self.span * self.uniform()
+        self.y = torch.zeros(len(self.labels), 1,
+                             dtype=self.dtype, device=self.device)
+        y = self.params.payoff(self.x[self.initial])
+        self.y[self.initial] = torch.as_tensor(
+            y, dtype=self.dtype, device=self.device)
+
+    def __iter__(self):
+        while True:
+            if self.steps % self.resample_every == 0:
+                self.resample()
+            self.steps += 1
+            yield self.x, self.y, self.labels, self.counts
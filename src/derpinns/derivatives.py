@@ -0,0 +1,107 @@
+import torch
+from torch.func import jacfwd, jacrev, jvp, vmap
+
+
+def autograd_derivatives(model, x, n_assets, dims=None):
+    """
+        Computes u, u_tau, u_x and u_xx using autograd, one reverse pass per asset for the Hessian.
+        If dims is given, only the Hessian rows of those assets are computed (the others are zero).
+    """
+    x.requires_grad_(True)
+    u = model(x)
+    grads = torch.autograd.grad(u.sum(), x, create_graph=True)[0]
+    u_tau = grads[:, -1]
+    u_x = grads[:, :n_assets]
+    if dims is None:
+        dims = range(n_assets)
+    u_xx_list = [torch.zeros_like(u_x)] * n_assets
+    for j in dims:
+        grad_j = torch.autograd.grad(u_x[:, j].sum(), x, create_graph=True,
+                                     retain_graph=True)[0][:, :n_assets]
+        u_xx_list[j] = grad_j
+    u_xx = torch.stack(u_xx_list, dim=1)
+    return u, u_tau, u_x, u_xx
+
+
+def vmap_derivatives(model, x, n_assets, dims=None, chunk_size=None):
+    """
+        Computes u, u_tau, u_x and u_xx with torch.func: the per-sample Hessian in the asset variables is
+        obtained by forward-over-reverse differentiation (jacfwd of jacrev) vectorized over the batch, so the
+        number of autograd calls does not grow with the number of assets.
+        If dims is given, the forward pass only differentiates along those assets (the other columns of
+        u_xx are zero).
+    """
+    if dims is None:
+        dims = range(n_assets)
+    # x_assets = rest + P @ x_dims, so differentiating w.r.t. x_dims gives the columns of dims
+    P = torch.eye(n_assets, dtype=x.dtype, device=x.device)[:, list(dims)]
+
+    def value(x_assets, x_tau):
+        u = model(torch.cat([x_assets, x_tau]).unsqueeze(0)).squeeze()
+        return u, u
+
+    def gradient(x_dims, x_rest, x_tau):
+        (u_x, u_tau), u = jacrev(value, argnums=(0, 1),
+                                 has_aux=True)(x_rest + P @ x_dims, x_tau)
+        return u_x, (u_x, u_tau, u)
+
+    x_assets = x[:, :n_assets]
+    x_dims = x_assets @ P
+    u_xx, (u_x, u_tau, u) = vmap(jacfwd(gradient, has_aux=True), chunk_size=chunk_size)(
+        x_dims, x_assets - x_dims @ P.T, x[:, n_assets:])
+    return u.unsqueeze(1), u_tau[:, 0], u_x, u_xx @ P.T
+
+
+def jvp_jet(f, x, directions):
+    """
+        Value, input Jacobian and second directional derivatives of a batched function using nested
+        forward-mode differentiation (jvp of jvp). Works for any model, but recomputes the forward pass
+        once per tangent.
+
+        directions: [d, K] shared by all samples or [B, d, K] per sample.
+        Returns u [B, out], jac [B, out, d] and d2 [B, out, K] with d2[..., k] = v_k^T H v_k.
+    """
+    B, d = x.shape
+    if directions.dim() == 2:
+        directions = directions.expand(B, -1, -1)
+    eye = torch.eye(d, dtype=x.dtype, device=x.device)
+
+    def first(v):
+        return jvp(f, (x,), (v,))[1]
+
+    def second(v):
+        return jvp(lambda y: jvp(f, (y,), (v,))[1], (x,), (v,))[1]
+
+    u = f(x)
+    jac = vmap(lambda e: first(e.expand(B, -1)), out_dims=2)(eye)
+    d2 = vmap(second, in_dims=2, out_dims=2)(directions)
+    return u, jac, d2
+
+
+def iter_chunks(fn, x, chunk_size=None, dtype=None, device=None):
+    """
+        Evaluates fn on the rows of x chunk_size at a time, yielding (start, output) for every chunk.
+        x may be a tensor, an array or a memmap larger than the device memory: every chunk is moved to
+        device (and dtype) on its own. Outputs are detached, so only the graph of one chunk is alive.
+    """
+    chunk_size = chunk_size or max(len(x), 1)
+    for start in range(0, len(x), chunk_size):
+        chunk = x[start:start + chunk_size]
+        if isinstance(chunk, torch.Tensor):
+            chunk = chunk.to(dtype=dtype, device=device)
+        else:
+            chunk = torch.tensor(chunk, dtype=dtype, device=device)
+        yield start, fn(chunk).detach()
+
+
+def evaluate_in_chunks(fn, x, chunk_size=None, dtype=None, device=None, out_device=None) -> torch.Tensor:
+    """
+        Concatenated outputs of iter_chunks, each chunk moved to out_device (e.g. the host) as it is done.
+    """
+    return torch.cat([out.to(out_device) for _, out in iter_chunks(fn, x, chunk_size, dtype, device)])
+
+
+DERIVATIVE_ENGINES = {
+    "autograd": autograd_derivatives,
+    "vmap": vmap_derivatives,
+}
@@ -2,6 +2,7 @@ from typing import Optional
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from derpinns.derivatives import jvp_jet
 
 
 class FourierEmbedding(nn.Module):
@@ -261,3 +262,77 @@ class FirstOrderNN(nn.Module):
         h = self.hidden_layers(x)
         out = self.output_layer(h)
         return out
+
+
+def activation_derivatives(activation: nn.Module, z: torch.Tensor):
+    """
+        Value, first and second derivative of a supported activation evaluated at z.
+    """
+    if isinstance(activation, nn.Tanh):
+        a = torch.tanh(z)
+        d1 = 1 - a**2
+        return a, d1, -2 * a * d1
+    if isinstance(activation, nn.Softplus):
+        # torch reverts to the identity above the threshold
+        linear = activation.beta * z > activation.threshold
+        s = torch.sigmoid(activation.beta * z)
+        d1 = torch.where(linear, torch.ones_like(s), s)
+        d2 = torch.where(linear, torch.zeros_like(s),
+                         activation.beta * s * (1 - s))
+        return activation(z), d1, d2
+    if isinstance(activation, nn.Sigmoid):
+        s = torch.sigmoid(z)
+        d1 = s * (1 - s)
+        return s, d1, d1 * (1 - 2 * s)
+    if isinstance(activation, nn.Identity):
+        return z, torch.ones_like(z), torch.zeros_like(z)
+    raise ValueError(f"Unsupported activation: {activation}")
+
+
+def supports_forward_jet(model: nn.Module) -> bool:
+    """
+        True if forward_jet can propagate through the model layer by layer.
+    """
+    if not isinstance(model, (NN, NNWithAnsatz, FirstOrderNN)):
+        return False
+    return all(isinstance(layer, (nn.Linear, nn.Tanh, nn.Softplus, nn.Sigmoid, nn.Identity))
+               for layer in model.hidden_layers)
+
+
+def forward_jet(model: nn.Module, x: torch.Tensor, directions: torch.Tensor):
+    """
+        Forward-mode propagation of value, input Jacobian and second directional derivatives through the
+        Linear/activation stack of NN, NNWithAnsatz and FirstOrderNN, in a single forward sweep and without
+        a second-order autograd tape. Summing d2 over the directions gives the weighted Laplacian
+        tr(V V^T H).
+
+        directions: [d, K] shared by all samples or [B, d, K] per sample.
+        Returns u [B, out], jac [B, out, d] and d2 [B, out, K] with d2[..., k] = v_k^T H v_k.
+    """
+    B, d = x.shape
+    if directions.dim() == 2:
+        directions = directions.expand(B, -1, -1)
+
+    # tangents are stored as [B, d + K, features]: the first d rows are the Jacobian, the last K the
+    # first directional derivatives, so each Linear applies one matmul to all of them.
+    h = x
+    eye = torch.eye(d, dtype=x.dtype, device=x.device).expand(B, d, d)
+    tangents = torch.cat([eye, directions.transpose(1, 2)], dim=1)
+    second = torch.zeros_like(directions.transpose(1, 2))
+    for layer in list(model.hidden_layers) + [model.output_layer]:
+        if isinstance(layer, nn.Linear):
+            h = layer(h)
+            tangents = tangents @ layer.weight.T
+            second = second @ layer.weight.T
+        else:
+            h, d1, d2 = activation_derivatives(layer, h)
+            first = tangents[:, d:, :]
+            second = d1.unsqueeze(1) * second + d2.unsqueeze(1) * first**2
+            tangents = d1.unsqueeze(1) * tangents
+
+    u, jac, d2 = h, tangents[:, :d, :].transpose(1, 2), second.transpose(1, 2)
+    if isinstance(model, NNWithAnsatz):
+        p, p_jac, p_d2 = jvp_jet(lambda y: model.payoff(
+            y[:, :model.input_dim-1]), x, directions)
+        u, jac, d2 = u + p, jac + p_jac, d2 + p_d2
+    return u, jac, d2
@@ -0,0 +1,106 @@
+from copy import copy, deepcopy
+from queue import Empty, Full, Queue
+import threading
+import time
+
+
+class BatchPrefetcher:
+    """
+        Builds the batches of a closure on a background thread while the training step runs, keeping at
+        most depth of them in a bounded queue. The producer works on a shallow copy of the closure whose
+        model is a frozen snapshot, refreshed every sync_every batches, so adaptive samplers score their
+        candidates against a recent model without racing with the optimizer.
+
+        The time the training loop spends waiting for a batch is accumulated in stall_time.
+    """
+
+    def __init__(self, depth: int = 2, sync_every: int = 10):
+        if depth < 1 or sync_every < 1:
+            raise ValueError("Invalid prefetch settings")
+        self.depth = depth
+        self.sync_every = sync_every
+
+        self.closure = None
+        self.producer = None
+        self.queue = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.steps = 0
+        self.stall_time = 0.0
+        self.start_time = None
+
+    def snapshot(self):
+        model = deepcopy(self.closure.model)
+        model.requires_grad_(False)
+        return model
+
+    def start(self, closure):
+        """
+            Starts producing batches for the closure. From now on the closure's batch stream is only
+            advanced by the producer.
+        """
+        self.stop()
+        self.closure = closure
+        self.producer = copy(closure)
+        self.producer.watchdog = None
+        self.producer.prefetcher = None
+        self.producer.model = self.snapshot()
+        self.queue = Queue(maxsize=self.depth)
+        self.stop_event.clear()
+        self.steps = 0
+        self.stall_time = 0.0
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+        return self
+
+    def produce(self):
+        try:
+            while not self.stop_event.is_set():
+                self.put((self.producer.produce_batch(), None))
+        except Exception as e:
+            self.put((None, e))
+
+    def put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def get(self) -> tuple:
+        """
+            Next batch (x, y, classes, counts). Errors of the producer are raised here.
+        """
+        start = time.perf_counter()
+        batch, error = self.queue.get()
+        self.stall_time += time.perf_counter() - start
+        if error is not None:
+            raise error
+        self.steps += 1
+        if self.steps % self.sync_every == 0:
+            # swapped as a whole, the producer picks it up at its next batch
+            self.producer.model = self.snapshot()
+        return batch
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+        self.thread.join()
+        self.thread = None
+
+    def report(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+        return {
+            "batches": self.steps,
+            "stall_time": self.stall_time,
+            "stall_per_batch": self.stall_time / self.steps if self.steps else 0.0,
+            "stall_fraction": self.stall_time / elapsed if elapsed > 0 else 0.0,
+        }
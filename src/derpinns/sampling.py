@@ -1,87 +1,480 @@
+from functools import lru_cache
 import numpy as np
-import skopt
-import warnings
+import torch
+from torch.quasirandom import SobolEngine
+from derpinns.derivatives import evaluate_in_chunks
 
-warnings.filterwarnings(
-    "ignore",
-    category=UserWarning,
-    module="skopt"
-)
+
+def spawn_seeds(seed, n):
+    """
+        Splits a seed (None, int or np.random.SeedSequence) into n independent, reproducible child
+        seeds, e.g. one per class or per worker.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+
+def numpy_generator(seed=None) -> np.random.Generator:
+    """
+        Local numpy generator for a seed (None, int, SeedSequence or Generator), the global state is
+        never touched.
+    """
+    return np.random.default_rng(seed)
+
+
+def torch_seed(seed):
+    """
+        Integer seed for torch generators derived from None, int, SeedSequence or Generator.
+    """
+    if seed is None or isinstance(seed, (int, np.integer)):
+        return seed
+    if isinstance(seed, np.random.SeedSequence):
+        return int(seed.generate_state(1, dtype=np.uint64)[0] >> np.uint64(1))
+    return int(seed.integers(2**63))
+
+
+def torch_generator(seed=None, device=None) -> torch.Generator:
+    """
+        Local torch generator on device, seeded from seed (fresh entropy if None).
+    """
+    generator = torch.Generator(device=device or "cpu")
+    seed = torch_seed(seed)
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    return generator
 
 
-def random_samples(n_samples, dimension, sampler="pseudo", seed=None):
+def random_samples(n_samples, dimension, sampler="pseudo", seed=None, dtype=None, device=None):
+    """
+        Samples in [0, 1]^dimension. Quasi-random samples are generated with torch, directly on device
+        with the given dtype; a torch tensor is returned if any of them is given, a numpy array otherwise.
+
+        seed may be None, an int, a np.random.SeedSequence or a np.random.Generator, the global random
+        states are not used.
+    """
     if sampler == "pseudo":
-        return pseudorandom(n_samples, dimension, seed)
+        samples = pseudorandom(n_samples, dimension, seed)
+        if dtype is None and device is None:
+            return samples
+        return torch.as_tensor(samples, dtype=dtype or torch.float64, device=device)
+    sparse_grid = as_sparse_grid(sampler)
+    if sparse_grid is not None:
+        samples = sparse_grid.sample(n_samples, sparse_grid.weights(dimension))
+        if dtype is None and device is None:
+            return samples
+        return torch.as_tensor(samples, dtype=dtype or torch.float64, device=device)
     if sampler in ["LHS", "Halton", "Hammersley", "Sobol"]:
-        return quasirandom(n_samples, dimension, sampler, seed)
-    raise ValueError("f{sampler} sampling is not available.")
+        samples = quasirandom(n_samples, dimension, sampler, seed,
+                              dtype=dtype or torch.float64, device=device)
+        if dtype is None and device is None:
+            return samples.numpy()
+        return samples
+    raise ValueError(f"{sampler} sampling is not available.")
 
 
 def pseudorandom(n_samples, dimension, seed=None):
-    np.random.seed(seed)
-    return np.random.random(size=(n_samples, dimension))
+    return numpy_generator(seed).random(size=(n_samples, dimension))
+
+
+def first_primes(n):
+    primes = []
+    candidate = 2
+    while len(primes) < n:
+        if all(candidate % p for p in primes if p * p <= candidate):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+
+def radical_inverse(idx, bases, dtype=torch.float64):
+    """
+        Van der Corput radical inverse of every index [n] in every base [d], vectorized over the points:
+        one digit of all points per iteration. Digits are extracted in float64 (exact below 2^53), and the
+        (ascending) bases only iterate over the digits they have.
+    """
+    max_idx = int(idx.max()) if len(idx) else 0
+    # mps has no float64
+    device = torch.device("cpu") if idx.device.type == "mps" else idx.device
+    # [d, n] layout, so the active bases are a contiguous block of rows
+    remaining = idx.to(device=device, dtype=torch.float64).repeat(len(bases), 1)
+    result = torch.zeros_like(remaining)
+    base = torch.tensor(bases, dtype=torch.float64, device=device).unsqueeze(1)
+    scale = 1.0 / base
+    power = list(bases)
+    while True:
+        active = sum(p <= max_idx * b for p, b in zip(power, bases))
+        if active == 0:
+            break
+        r, b = remaining[:active], base[:active]
+        quotient = torch.floor(r / b)
+        result[:active] += (r - quotient * b) * scale[:active]
+        remaining[:active] = quotient
+        scale[:active] = scale[:active] / b
+        power = [p * b for p, b in zip(power, bases)]
+    return result.T.contiguous().to(device=idx.device, dtype=dtype)
 
 
-def quasirandom(n_samples, dimension, sampler, seed=None):
+def halton(n_samples, dimension, skip=1, dtype=torch.float64, device=None):
+    idx = torch.arange(skip, skip + n_samples, device=device)
+    return radical_inverse(idx, first_primes(dimension), dtype)
+
+
+def hammersley(n_samples, dimension, skip=1, dtype=torch.float64, device=None):
+    """
+        Halton points in the first dimension - 1 coordinates and i / (n_samples + skip) in the last.
+    """
+    if dimension == 1:
+        return halton(n_samples, 1, skip, dtype, device)
+    idx = torch.arange(skip, skip + n_samples, device=device)
+    last = idx.to(dtype).unsqueeze(1) / (n_samples + skip)
+    return torch.cat([radical_inverse(idx, first_primes(dimension - 1), dtype), last], dim=1)
+
+
+def latin_hypercube(n_samples, dimension, seed=None, dtype=torch.float64, device=None):
+    """
+        Classic LHS: every coordinate takes one uniform point in each of the n_samples strata, with the
+        strata randomly permuted per dimension.
+    """
+    generator = torch_generator(seed, device)
+    strata = torch.argsort(torch.rand(dimension, n_samples, generator=generator, device=device), dim=1).T
+    jitter = torch.rand(n_samples, dimension, generator=generator, dtype=dtype, device=device)
+    return (strata.to(dtype) + jitter) / n_samples
+
+
+def quasirandom(n_samples, dimension, sampler, seed=None, dtype=torch.float64, device=None):
     """
         Certain points should be removed:
         - Boundary points such as [..., 0, ...]
         - Special points [0, 0, 0, ...] and [0.5, 0.5, 0.5, ...], which cause error in
         Hypersphere.random_points() and Hypersphere.random_boundary_points()
+
+        Halton and Hammersley skip their first point ([0, 0, ...]), Sobol is scrambled so it has none of
+        them.
     """
-    skip = 0
     if sampler == "LHS":
-        sampler = skopt.sampler.Lhs()
-    elif sampler == "Halton":
-        # 1st point: [0, 0, ...]
-        sampler = skopt.sampler.Halton(min_skip=1, max_skip=1)
-    elif sampler == "Hammersley":
-        # 1st point: [0, 0, ...]
-        if dimension == 1:
-            sampler = skopt.sampler.Hammersly(min_skip=1, max_skip=1)
-        else:
-            sampler = skopt.sampler.Hammersly()
-            skip = 1
-    elif sampler == "Sobol":
-        # 1st point: [0, 0, ...], 2nd point: [0.5, 0.5, ...]
-        sampler = skopt.sampler.Sobol(randomize=False)
-        if dimension < 3:
-            skip = 1
-        else:
-            skip = 2
-    space = [(0.0, 1.0)] * dimension
-    return np.asarray(
-        sampler.generate(space, n_samples + skip, random_state=seed)[skip:]
-    )
+        return latin_hypercube(n_samples, dimension, seed, dtype, device)
+    if sampler == "Halton":
+        return halton(n_samples, dimension, 1, dtype, device)
+    if sampler == "Hammersley":
+        return hammersley(n_samples, dimension, 1, dtype, device)
+    if sampler == "Sobol":
+        engine = SobolEngine(dimension, scramble=True, seed=torch_seed(seed))
+        return engine.draw(n_samples, dtype=dtype).to(device)
+    raise ValueError(f"{sampler} sampling is not available.")
+
+
+def clenshaw_curtis_nodes(level):
+    """
+        Nodes added at a level of the nested Clenshaw-Curtis rule without boundary points: the rule of level l
+        has the 2^(l+1) - 1 interior Chebyshev extrema 0.5 * (1 - cos(pi * k / 2^(l+1))), the odd k are new.
+    """
+    m = 2 ** (level + 1)
+    return 0.5 * (1 - np.cos(np.pi * np.arange(1, m, 2) / m))
+
+
+@lru_cache(maxsize=None)
+def leja_sequence(n_points, n_candidates=2**14):
+    """
+        First n_points of the Leja sequence in (0, 1) weighted by sqrt(x * (1 - x)), which keeps the points away
+        from the boundary: starting at 0.5, every point maximizes sqrt(w(x)) * prod_j |x - x_j| over a
+        fine grid.
+    """
+    candidates = np.linspace(0, 1, n_candidates + 1)[1:-1]
+    objective = 0.5 * np.log(candidates * (1 - candidates))
+    points = []
+    for _ in range(n_points):
+        points.append(candidates[np.argmax(objective)])
+        with np.errstate(divide="ignore"):
+            objective = objective + np.log(np.abs(candidates - points[-1]))
+    return np.array(points)
+
+
+def leja_nodes(level):
+    """
+        Node added at a level of the Leja rule (one point per level).
+    """
+    return leja_sequence(level + 1)[level:]
+
+
+SPARSE_GRID_RULES = {
+    "clenshaw-curtis": clenshaw_curtis_nodes,
+    "leja": leja_nodes,
+}
+
+
+class SparseGrid:
+    """
+        Smolyak sparse grid in [0, 1]^d built from a nested one dimensional rule ("clenshaw-curtis" or "leja").
+        The grid of level L is the union of the tensor products of the nodes added at levels i_1, ..., i_d
+        over the multi-indices with sum_j w_j * i_j <= L. The weights are 1 for the assets and time_weight for
+        the time (last) coordinate, so time_weight > 1 refines time less than the assets.
+
+        Points are ordered level by level, the first n_samples are returned. With level=None the smallest
+        level with at least n_samples points is used, size() gives the size of the complete grids. The grid
+        is deterministic, seeds are ignored.
+
+        Use it as sampler= in random_samples and generate_dataset, "Smolyak" and "Smolyak-Leja" are the
+        default grids of each rule.
+    """
+
+    def __init__(self, rule="clenshaw-curtis", level=None, time_weight=1.0):
+        if rule not in SPARSE_GRID_RULES:
+            raise ValueError(f"Invalid sparse grid rule: {rule}")
+        if level is not None and level < 0:
+            raise ValueError("Invalid level")
+        if time_weight <= 0:
+            raise ValueError("Invalid time_weight")
+        self.rule = rule
+        self.level = level
+        self.time_weight = time_weight
+
+    def __repr__(self):
+        return f"SparseGrid(rule={self.rule!r}, level={self.level}, time_weight={self.time_weight})"
+
+    def weights(self, dimension):
+        return [1.0] * (dimension - 1) + [self.time_weight]
+
+    def indices(self, weights, level):
+        """
+            Multi-indices of the grid of the given level, sorted by weighted level.
+        """
+        indices = [((), 0.0)]
+        for w in weights:
+            indices = [(index + (i,), cost + w * i) for index, cost in indices
+                       for i in range(int((level - cost) / w + 1e-9) + 1)]
+        indices.sort(key=lambda item: item[1])
+        return np.array([index for index, _ in indices], dtype=np.int64).reshape(len(indices), len(weights))
+
+    def size(self, dimension, level=None, weights=None):
+        """
+            Number of points of the complete grid of the given level (self.level by default).
+        """
+        level = self.level if level is None else level
+        weights = self.weights(dimension) if weights is None else weights
+        indices = self.indices(weights, level)
+        counts = np.array([len(SPARSE_GRID_RULES[self.rule](l)) for l in range(indices.max(initial=0) + 1)])
+        return int(counts[indices].prod(axis=1).sum())
+
+    def sample(self, n_samples, weights):
+        """
+            First n_samples points of the grid over len(weights) coordinates with the given weights.
+        """
+        level = self.level
+        if level is None:
+            level = 0
+            while self.size(len(weights), level, weights) < n_samples:
+                level += 1
+        elif self.size(len(weights), level, weights) < n_samples:
+            raise ValueError(f"The sparse grid of level {level} has less than {n_samples} points")
+
+        indices = self.indices(weights, level)
+        nodes = [SPARSE_GRID_RULES[self.rule](l) for l in range(indices.max(initial=0) + 1)]
+        counts = np.array([len(n) for n in nodes])
+        table = np.zeros((len(nodes), counts.max()))
+        for l, n in enumerate(nodes):
+            table[l, :len(n)] = n
+
+        # point k of the grid is a mixed radix offset within the tensor product of its multi-index
+        sizes = counts[indices].prod(axis=1)
+        block = np.repeat(np.arange(len(indices)), sizes)[:n_samples]
+        offset = np.arange(len(block)) - (np.cumsum(sizes) - sizes)[block]
+        samples = np.empty((len(block), len(weights)))
+        for j in reversed(range(len(weights))):
+            levels = indices[block, j]
+            offset, digit = np.divmod(offset, counts[levels])
+            samples[:, j] = table[levels, digit]
+        return samples
+
+
+SPARSE_GRIDS = {
+    "Smolyak": SparseGrid("clenshaw-curtis"),
+    "Smolyak-Leja": SparseGrid("leja"),
+}
+
+
+def as_sparse_grid(sampler):
+    """
+        The SparseGrid a sampler refers to, None for the other samplers.
+    """
+    if isinstance(sampler, SparseGrid):
+        return sampler
+    return SPARSE_GRIDS.get(sampler) if isinstance(sampler, str) else None
 
 
 def scale_samples(samples, ranges):
-    scaled_samples = []
-    for i in range(samples.shape[1]):
-        a, b = ranges[i]
-        scaled_samples.append(a + (b - a) * samples[:, i])
-    return np.array(scaled_samples).T
+    """
+        Maps samples in [0, 1]^d to the box given by the (low, high) ranges, for numpy arrays and tensors.
+    """
+    if isinstance(samples, torch.Tensor):
+        ranges = torch.as_tensor(ranges, dtype=samples.dtype, device=samples.device)
+        return torch.addcmul(ranges[:, 0], ranges[:, 1] - ranges[:, 0], samples)
+    ranges = np.asarray(ranges, dtype=float)
+    return ranges[:, 0] + (ranges[:, 1] - ranges[:, 0]) * samples
 
 
-def residual_based_adaptive_sampling(res_f, n_samples, ranges, k, c, sampler="pseudo", seed=None):
+def residual_based_adaptive_sampling(res_f, n_samples, ranges, k, c, sampler="pseudo", seed=None, chunk_size=None):
     """
         Implementation of the residual-based adaptive sampling method.
         https://www.sciencedirect.com/science/article/pii/S0045782522006260?via%3Dihub
+
+        res_f is evaluated on chunk_size candidates at a time (all of them by default).
     """
-    samples = random_samples(n_samples*10, len(ranges), sampler, seed=seed)
+    samples_seed, choice_seed = spawn_seeds(seed, 2)
+    samples = random_samples(n_samples*10, len(ranges), sampler, seed=samples_seed)
     scl_samples = scale_samples(samples, ranges)
-    residual = res_f(scl_samples)
+    chunk_size = chunk_size or len(scl_samples)
+    residual = np.concatenate([np.reshape(res_f(scl_samples[i:i + chunk_size]), -1)
+                               for i in range(0, len(scl_samples), chunk_size)])
 
     err = np.abs(residual)
     err_eq = np.power(err, k) / np.power(err, k).mean() + c
     err_eq_normalized = err_eq / np.sum(err_eq)
 
-    selected_ids = np.random.choice(
+    selected_ids = numpy_generator(choice_seed).choice(
         a=len(scl_samples), size=n_samples, replace=False, p=err_eq_normalized)
     selected_samples = scl_samples[selected_ids, :]
     return selected_samples
 
 
+class ResidualBasedAdaptiveSampler:
+    """
+        Residual-based adaptive sampling kept on the training device. A pool of pool_size candidates is
+        drawn once; every refresh_every steps the oldest refresh_fraction of it is redrawn and the residuals
+        of the pool are evaluated again, in chunks of chunk_size points to bound the memory of the
+        derivatives. At every step the points are drawn from the pool with torch.multinomial (without
+        replacement) with probabilities proportional to |r|^k / mean(|r|^k) + c.
+
+        Candidates from the deterministic samplers (Halton, Hammersley, sparse grids) are re-randomized by
+        a random shift modulo 1, so refreshes do not redraw the same points.
+    """
+
+    def __init__(self, ranges, pool_size, k=1, c=1, sampler="pseudo", refresh_every=1, refresh_fraction=1.0, chunk_size=None, seed=None, dtype=torch.float32, device=None):
+        if pool_size < 1 or refresh_every < 1 or not 0 < refresh_fraction <= 1:
+            raise ValueError("Invalid pool settings")
+        ranges = torch.as_tensor(ranges, dtype=dtype, device=device)
+        self.low = ranges[:, 0]
+        self.span = ranges[:, 1] - ranges[:, 0]
+        self.pool_size = pool_size
+        self.k = k
+        self.c = c
+        self.sampler = sampler
+        self.refresh_every = refresh_every
+        self.n_refresh = max(1, round(refresh_fraction * pool_size))
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.device = device
+
+        self.seeds = np.random.SeedSequence(seed)
+        self.generator = torch_generator(spawn_seeds(self.seeds, 1)[0], device)
+        self.pool = None
+        self.weights = None
+        self.cursor = 0
+        self.steps = 0
+
+    def draw(self, n_samples) -> torch.Tensor:
+        """
+            n_samples fresh candidates in the domain.
+        """
+        dimension = len(self.low)
+        if self.sampler == "pseudo":
+            samples = torch.rand((n_samples, dimension), generator=self.generator,
+                                 dtype=self.dtype, device=self.device)
+        else:
+            samples = random_samples(n_samples, dimension, self.sampler, seed=spawn_seeds(self.seeds, 1)[0],
+                                     dtype=self.dtype, device=self.device)
+            if self.sampler not in ("LHS", "Sobol"):
+                shift = torch.rand((1, dimension), generator=self.generator,
+                                   dtype=self.dtype, device=self.device)
+                samples = torch.remainder(samples + shift, 1.0)
+        return torch.addcmul(self.low, self.span, samples)
+
+    def refresh(self):
+        if self.pool is None:
+            self.pool = self.draw(self.pool_size)
+            return
+        # the oldest candidates are replaced, walking through the pool
+        idx = torch.arange(self.cursor, self.cursor + self.n_refresh, device=self.device) % self.pool_size
+        self.pool[idx] = self.draw(self.n_refresh)
+        self.cursor = (self.cursor + self.n_refresh) % self.pool_size
+
+    def evaluate(self, residual_fn) -> torch.Tensor:
+        """
+            Sampling weights of the pool from the residuals, evaluated chunk by chunk.
+        """
+        err = evaluate_in_chunks(residual_fn, self.pool, self.chunk_size).abs().reshape(-1) ** self.k
+        return err / err.mean().clamp(min=torch.finfo(err.dtype).tiny) + self.c
+
+    def sample(self, residual_fn, n_samples) -> torch.Tensor:
+        """
+            To be called once per step: returns n_samples points of the pool [n_samples, d], refreshing
+            the pool and the weights every refresh_every steps.
+        """
+        if n_samples > self.pool_size:
+            raise ValueError(f"Cannot draw {n_samples} points from a pool of {self.pool_size}")
+        if self.steps % self.refresh_every == 0:
+            self.refresh()
+            self.weights = self.evaluate(residual_fn)
+        self.steps += 1
+        idx = torch.multinomial(self.weights, n_samples, replacement=False, generator=self.generator)
+        return self.pool[idx]
+
+
+class SumTree:
+    """
+        Binary sum-tree over n_leaves non-negative priorities, kept on the device. Proportional sampling
+        descends the tree for the whole batch at once and updates recompute the ancestors of the changed
+        leaves, both O(B log N) without host syncs.
+    """
+
+    def __init__(self, n_leaves, dtype=torch.float32, device=None):
+        if n_leaves < 1:
+            raise ValueError("Invalid number of leaves")
+        self.n_leaves = n_leaves
+        self.capacity = 1 << (n_leaves - 1).bit_length()
+        self.depth = self.capacity.bit_length() - 1
+        self.tree = torch.zeros(2 * self.capacity, dtype=dtype, device=device)
+
+    @property
+    def total(self) -> torch.Tensor:
+        return self.tree[1]
+
+    def fill(self, priorities):
+        """
+            Sets all the priorities, rebuilding the tree level by level.
+        """
+        self.tree.zero_()
+        self.tree[self.capacity:self.capacity + self.n_leaves] = priorities
+        size = self.capacity
+        while size > 1:
+            self.tree[size // 2:size] = self.tree[size:2 * size].view(-1, 2).sum(1)
+            size //= 2
+
+    def update(self, idx: torch.Tensor, priorities):
+        node = idx + self.capacity
+        self.tree[node] = torch.as_tensor(priorities, dtype=self.tree.dtype, device=self.tree.device)
+        for _ in range(self.depth):
+            node = node // 2
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+
+    def sample(self, n_samples, generator=None) -> torch.Tensor:
+        """
+            n_samples leaves drawn with replacement, with probabilities proportional to their priorities.
+        """
+        target = torch.rand(n_samples, generator=generator, dtype=self.tree.dtype,
+                            device=self.tree.device) * self.total
+        node = torch.ones(n_samples, dtype=torch.long, device=self.tree.device)
+        for _ in range(self.depth):
+            left = self.tree[2 * node]
+            right = target >= left
+            target = torch.where(right, target - left, target)
+            node = 2 * node + right
+        # rounding may land on the zero padding past the last leaf
+        return (node - self.capacity).clamp(max=self.n_leaves - 1)
+
+
 if __name__ == "__main__":
     # Example usage of residual_based_adaptive_sampling
     import matplotlib.pyplot as plt
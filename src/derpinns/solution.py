@@ -4,7 +4,7 @@ from scipy.stats import norm
 import numpy as np
 import time
 import torch
-from derpinns.sampling import random_samples
+from derpinns.sampling import random_samples, spawn_seeds, torch_generator
 
 
 @torch.no_grad()
@@ -19,10 +19,10 @@ def compare_with_mc(
     split_output=False,
 ):
     """
-        Vectorised NN-vs-MC comparison.
+        Vectorised NN-vs-MC comparison. seed drives local random streams (the prices and the Sobol normals
+        are drawn independently), the global random states are left untouched.
     """
-    torch.manual_seed(seed)
-    np.random.seed(seed)
+    prices_seed, normals_seed = spawn_seeds(seed, 2)
 
     r = torch.as_tensor(params.r,   dtype=dtype, device=device)
     tau = torch.as_tensor(params.tau, dtype=dtype, device=device)
@@ -30,9 +30,8 @@ def compare_with_mc(
     rho = torch.as_tensor(params.rho,   dtype=dtype, device=device)
     sigma = torch.as_tensor(params.sigma, dtype=dtype, device=device)
 
-    x0 = torch.empty((n_prices, params.n_assets),
-                     dtype=dtype, device=device).uniform_(params.x_min,
-                                                          params.x_max)
+    x0 = torch.empty((n_prices, params.n_assets), dtype=dtype, device=device)\
+        .uniform_(params.x_min, params.x_max, generator=torch_generator(prices_seed, device))
     s0 = torch.exp(x0) * params.strike
 
     # not implmeneted in mps, use numpy cholesky instead
@@ -60,9 +59,12 @@ def compare_with_mc(
 
     t0 = time.perf_counter()
 
+    # float64 inverse CDF on the host (Sobol points are drawn there anyway, mps has no float64)
     Z = random_samples(n_prices * n_simulations, params.n_assets,
-                       sampler="Sobol")
-    Z = torch.as_tensor(norm.ppf(Z), dtype=dtype, device=device)
+                       sampler="Sobol", seed=normals_seed, dtype=torch.float64)
+    eps = torch.finfo(torch.float64).eps
+    Z = torch.special.ndtri(Z.clamp(eps, 1 - eps)).to(
+        dtype=dtype, device=device)
 
     # apply correlation
     Z = Z @ L.T
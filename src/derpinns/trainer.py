@@ -1,12 +1,15 @@
 from torch.optim import Optimizer
 from tqdm import tqdm
 import torch
+import time
 import os
 
 from derpinns.solution import *
 from derpinns.datasets import *
 from derpinns.closures import *
 from derpinns.optimizer import *
+from derpinns.watchdog import NumericsWatchdog
+from derpinns.prefetch import BatchPrefetcher
 
 
 class PINNTrainer:
@@ -20,6 +23,11 @@ class PINNTrainer:
         self.epochs = None
         self.scheduler = None
         self.preconditioner = None
+        self.watchdog = NumericsWatchdog()
+        self.compile_opts = None
+        self.compile_report = None
+        self.prefetcher = None
+        self.prefetch_report = None
         self.device = torch.device(
             "cuda") if torch.cuda.is_available() else torch.device("mps")
         self.dtype = torch.float32
@@ -61,7 +69,93 @@ class PINNTrainer:
         self.preconditioner = preconditioner
         return self
 
+    def with_watchdog(self, watchdog: NumericsWatchdog):
+        '''
+            Numerics watchdog checking for NaN/Inf values every few steps, use
+            NumericsWatchdog(debug=True) to run the training with autograd anomaly detection.
+        '''
+        self.watchdog = watchdog
+        return self
+
+    def with_compile(self, benchmark_steps: int = 5, **compile_opts):
+        '''
+            Compiles the derivative and loss computation of the closure with torch.compile, using
+            batches with a static class composition. Before training, benchmark_steps eager and compiled
+            steps are timed and the result is stored in compile_report.
+        '''
+        self.compile_opts = compile_opts
+        self.benchmark_steps = benchmark_steps
+        return self
+
+    def with_prefetch(self, depth: int = 2, sync_every: int = 10):
+        '''
+            Builds the batches on a background thread while the optimizer steps (see BatchPrefetcher), with
+            at most depth batches ahead. Adaptive samplers score candidates against a model snapshot taken
+            every sync_every steps. The time spent waiting for batches is stored in prefetch_report.
+        '''
+        self.prefetcher = BatchPrefetcher(depth, sync_every)
+        return self
+
+    def time_steps(self, steps: int) -> list[float]:
+        '''
+            Wall time of forward and backward passes of the closure, without updating the model.
+        '''
+        times = []
+        for _ in range(steps):
+            start = time.perf_counter()
+            self.closure.next_batch()
+            loss = self.closure(update_status=False)
+            loss.backward()
+            self.optimizer.zero_grad()
+            if self.device.type == "cuda":
+                torch.cuda.synchronize(self.device)
+            times.append(time.perf_counter() - start)
+        return times
+
+    def compile_closure(self):
+        '''
+            Compiles the closure and reports the compile time against the steady-state speedup.
+        '''
+        eager = self.time_steps(self.benchmark_steps + 1)[1:]
+        self.closure.compile(**self.compile_opts)
+        compiled = self.time_steps(self.benchmark_steps + 1)
+
+        eager_step = float(np.median(eager))
+        compiled_step = float(np.median(compiled[1:]))
+        compile_time = compiled[0] - compiled_step
+        saved = eager_step - compiled_step
+        self.compile_report = {
+            "compile_time": compile_time,
+            "eager_step": eager_step,
+            "compiled_step": compiled_step,
+            "speedup": eager_step / compiled_step,
+            "break_even_steps": compile_time / saved if saved > 0 else float("inf"),
+        }
+        tqdm.write(
+            f"torch.compile: {compile_time:.2f}s to compile, step {eager_step*1e3:.1f}ms -> "
+            f"{compiled_step*1e3:.1f}ms ({self.compile_report['speedup']:.2f}x), "
+            f"break-even after {self.compile_report['break_even_steps']:.0f} steps")
+
     def train(self):
+        self.closure.with_watchdog(self.watchdog)
+        self.watchdog.watch(self.closure.model, self.optimizer)
+        if self.compile_opts is not None:
+            self.compile_closure()
+        if self.prefetcher is not None:
+            self.closure.with_prefetcher(self.prefetcher.start(self.closure))
+        try:
+            with self.watchdog.anomaly_mode():
+                self.run()
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.stop()
+                self.closure.with_prefetcher(None)
+                self.prefetch_report = self.prefetcher.report()
+                tqdm.write(
+                    f"prefetch: {self.prefetch_report['stall_time']:.2f}s waiting for batches "
+                    f"({self.prefetch_report['stall_fraction']:.1%} of the training time)")
+
+    def run(self):
 
         if isinstance(self.optimizer, LBFGS) or isinstance(self.optimizer, BFGS) or isinstance(self.optimizer, SSBroyden):
             pbar = tqdm(range(self.optimizer.state_dict()
@@ -104,6 +198,7 @@ class PINNTrainer:
 
             self.closure.next_batch()
             self.optimizer.step(closure)
+            self.watchdog.check()
             pbar.close()
 
         elif isinstance(self.optimizer, NysNewtonCG):
@@ -125,6 +220,8 @@ class PINNTrainer:
                     self.optimizer.update_preconditioner(grad_tuple)
 
                 _ = self.optimizer.step(closure)
+                if self.watchdog.step():
+                    pbar.write(f"NaN/Inf detected, rolled back at epoch {epoch}")
 
                 results = compare_with_mc(self.closure.model,
                                           self.closure.dataset.params, n_prices=5, n_simulations=10_000, dtype=self.dtype, device=self.device, seed=44)
@@ -146,11 +243,14 @@ class PINNTrainer:
                 self.closure.next_batch()
                 self.optimizer.zero_grad()
                 loss = self.closure()
+                self.watchdog.observe(loss=loss)
                 loss.backward()
 
                 if self.preconditioner:
                     self.preconditioner.step()
                 self.optimizer.step()
+                if self.watchdog.step():
+                    pbar.write(f"NaN/Inf detected, rolled back at epoch {epoch}")
 
                 if isinstance(self.closure, FOPINNClosure):
                     results = compare_with_mc(self.closure.model,
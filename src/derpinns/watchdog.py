@@ -0,0 +1,93 @@
+from contextlib import nullcontext
+from copy import deepcopy
+import torch
+
+
+class NumericsWatchdog:
+    """
+        Keeps NaN/Inf flags of the observed tensors on the device and only inspects them every check_every
+        steps, so training does not sync with the host on every step. When a flag is raised, the model and
+        optimizer are rolled back to the last snapshot that passed a check.
+
+        debug=True enables autograd anomaly detection for the training loop and checks every step.
+    """
+
+    def __init__(self, check_every: int = 100, max_rollbacks: int = 3, debug: bool = False):
+        if check_every < 1:
+            raise ValueError("Invalid check_every")
+        self.check_every = 1 if debug else check_every
+        self.max_rollbacks = max_rollbacks
+        self.debug = debug
+
+        self.model = None
+        self.optimizer = None
+        self.snapshot = None
+        self.flags = {}
+        self.steps = 0
+        self.rollbacks = 0
+
+    def anomaly_mode(self):
+        """
+            Context for the training loop: autograd anomaly detection in debug runs only.
+        """
+        return torch.autograd.detect_anomaly() if self.debug else nullcontext()
+
+    def watch(self, model: torch.nn.Module, optimizer=None):
+        """
+            Starts watching a training run, taking the first snapshot.
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.flags = {}
+        self.steps = 0
+        self.rollbacks = 0
+        self.take_snapshot()
+        return self
+
+    def observe(self, **tensors):
+        """
+            Accumulates, without syncing, whether any of the named tensors has a non-finite value.
+        """
+        for name, tensor in tensors.items():
+            bad = ~torch.isfinite(tensor.detach()).all()
+            self.flags[name] = self.flags[name] | bad if name in self.flags else bad
+
+    def take_snapshot(self):
+        self.snapshot = (
+            deepcopy(self.model.state_dict()),
+            deepcopy(self.optimizer.state_dict()) if self.optimizer else None,
+        )
+
+    def step(self) -> bool:
+        """
+            To be called after every optimizer step. Returns True if the run was rolled back.
+        """
+        self.steps += 1
+        if self.steps % self.check_every:
+            return False
+        return self.check()
+
+    def check(self) -> bool:
+        """
+            Inspects the accumulated flags (one host sync). A clean check takes a new snapshot, a failed
+            one restores the last snapshot. Returns True if the run was rolled back.
+        """
+        self.observe(**{f"param:{name}": p for name, p in self.model.named_parameters()})
+        names = list(self.flags)
+        bad = torch.stack(list(self.flags.values())).tolist()
+        self.flags = {}
+
+        failed = [name for name, b in zip(names, bad) if b]
+        if not failed:
+            self.take_snapshot()
+            return False
+
+        self.rollbacks += 1
+        if self.rollbacks > self.max_rollbacks:
+            raise ValueError(f"NaN @ {', '.join(failed)}")
+        model_state, optimizer_state = self.snapshot
+        self.model.load_state_dict(model_state)
+        if self.optimizer:
+            # the optimizer may keep references to the loaded tensors
+            self.optimizer.load_state_dict(deepcopy(optimizer_state))
+        return True
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import torch
+
+from derpinns.collocations import OptionParameters, payoff
+from derpinns.datasets import SampledDataset
+from derpinns.nn import build_nn
+
+
+def option_parameters(n_assets=2):
+    sigma = np.array([0.2 + 0.02 * i for i in range(n_assets)])
+    rho = np.eye(n_assets) + 0.25 * (np.ones((n_assets, n_assets)) - np.eye(n_assets))
+    return OptionParameters(n_assets=n_assets, tau=1.0, sigma=sigma, rho=rho, r=0.05, strike=100, payoff=payoff)
+
+
+@pytest.fixture
+def params():
+    return option_parameters()
+
+
+@pytest.fixture
+def dataset(params):
+    return SampledDataset(params, 200, 50, 10, "pseudo", torch.float64, torch.device("cpu"), seed=0)
+
+
+@pytest.fixture
+def model(params):
+    torch.manual_seed(0)
+    return build_nn("8x2", params.n_assets, dtype=torch.float64)
@@ -0,0 +1,119 @@
+import pytest
+import torch
+
+from derpinns import closures
+from derpinns.closures import ActiveSetDimlessBS, DimlessBS, EigenDirectionalDimlessBS, ForwardLaplacianDimlessBS, \
+    HutchinsonDimlessBS, PrioritizedReplayDimlessBS
+from derpinns.datasets import CollocationStream, SampledDataset
+from derpinns.nn import NNWithAnsatz, build_nn
+from conftest import option_parameters
+
+
+def test_prioritized_replay_share_stays_at_target(dataset):
+    closure = PrioritizedReplayDimlessBS(k=1, c=1, seed=0).with_dataset(dataset, {"batch_size": 64})
+    n = closure.priorities.n_leaves
+    # half of the buffer has |r| = 3, the other half |r| = 0: the target share of the high points is
+    # (3 / 1.5 + 1) / ((3 / 1.5 + 1) + (0 / 1.5 + 1)) = 0.75
+    high = torch.arange(n) < n // 2
+    residual = torch.where(high, 3.0, 0.0).double()
+    for _ in range(2000):
+        closure.replay_idx = closure.sample_replay(64)
+        closure.replay_residual = residual[closure.replay_idx]
+        closure.update_priorities()
+    share = high[closure.sample_replay(100_000)].double().mean().item()
+    assert abs(share - 0.75) < 0.01
+
+
+def exact_and_estimated_diffusion(dataset, model, distribution, n_probes=4000):
+    x = dataset.points(torch.arange(5))
+    exact = ForwardLaplacianDimlessBS().with_dataset(dataset, {"batch_size": 64}).with_model(model)
+    estimator = HutchinsonDimlessBS(n_probes=n_probes, distribution=distribution, seed=0)\
+        .with_dataset(dataset, {"batch_size": 64}).with_model(model)
+    diffusion = exact.compute_derivatives(x)[3].detach()
+    estimate = estimator.compute_derivatives(x)[3].detach()
+    return diffusion, estimate, estimator.probe_variance[-1]
+
+
+@pytest.mark.parametrize("distribution", ["rademacher", "gaussian"])
+def test_hutchinson_is_unbiased(dataset, model, distribution):
+    diffusion, estimate, variance = exact_and_estimated_diffusion(dataset, model, distribution)
+    assert (estimate - diffusion).abs().le(5 * variance.sqrt() + 1e-12).all()
+
+
+def run_active_set(dataset, model, loader_opts):
+    closure = ActiveSetDimlessBS(quantile=0.5, score_every=3, revisit_every=4, min_active=0.2, seed=0)\
+        .with_dataset(dataset, loader_opts).with_model(model)\
+        .with_device(torch.device("cpu")).with_dtype(torch.float64)
+    for step in range(1, 13):
+        closure.next_batch()
+        interior = closure.x[closure.class_slice(0)]
+        expected = closure.active if step % 4 else ~closure.active
+        points = dataset.points(expected.nonzero().flatten())
+        assert (torch.cdist(interior, points).min(1).values < 1e-6).all()
+        yield closure, len(points)
+        closure()
+    assert closure.state["active_fraction"][-1] < 0.5
+    assert closure.active.float().mean() >= 0.2
+
+
+def test_active_set_shrinks_the_interior_slice(dataset, model):
+    sizes = []
+    for closure, set_size in run_active_set(dataset, model, {"batch_size": 128, "shuffle": True, "seed": 0}):
+        assert closure.class_count(0) <= set_size
+        assert (closure.classes[closure.class_slice(0)] == 0).all()
+        assert len(closure.x) == len(closure.y) == len(closure.classes) == closure.offsets[-1]
+        sizes.append((closure.class_count(0), set_size))
+    assert (40, 40) in sizes
+
+
+def test_active_set_keeps_static_batch_shapes(dataset, model):
+    shapes = set()
+    for closure, _ in run_active_set(dataset, model, {"batch_size": 128, "static": True, "shuffle": True, "seed": 0}):
+        n_samples = closure.batch_sampler.counts[0]
+        assert closure.class_count(0) == n_samples or closure.class_count(0) & (closure.class_count(0) - 1) == 0
+        assert closure.offsets[-1] - closure.class_count(0) == sum(closure.batch_sampler.counts[1:])
+        shapes.add(closure.class_count(0))
+    assert shapes == {closure.batch_sampler.counts[0], 64}
+
+
+def test_per_point_closures_need_resident_points(params):
+    stream = CollocationStream(params, 16, 8, 2, seed=0)
+    for closure in (ActiveSetDimlessBS(), PrioritizedReplayDimlessBS()):
+        with pytest.raises(ValueError):
+            closure.with_dataset(stream, {})
+
+
+EQUIVALENT_CLOSURES = {
+    "forward_jet": ForwardLaplacianDimlessBS,
+    "jvp_jet": ForwardLaplacianDimlessBS,
+    "vmap": lambda: DimlessBS().with_derivative_engine("vmap"),
+    "vmap_split_faces": lambda: DimlessBS().with_derivative_engine("vmap").with_split_faces(True),
+    "autograd_split_faces": lambda: DimlessBS().with_split_faces(True),
+    "eigen": EigenDirectionalDimlessBS,
+}
+
+
+def models_for(n_assets):
+    torch.manual_seed(0)
+    yield build_nn("8x2", n_assets, dtype=torch.float64)
+    # a low threshold sends part of the pre-activations through the linear branch of Softplus
+    yield NNWithAnsatz(2, n_assets + 1, 8, 1, dtype=torch.float64, activation=torch.nn.Softplus(threshold=0.5)).double()
+
+
+@pytest.mark.parametrize("n_assets", [2, 3])
+@pytest.mark.parametrize("name", list(EQUIVALENT_CLOSURES))
+def test_closures_match_the_autograd_losses(monkeypatch, n_assets, name):
+    if name == "jvp_jet":
+        monkeypatch.setattr(closures, "supports_forward_jet", lambda model: False)
+    dataset = SampledDataset(option_parameters(n_assets), 200, 50, 10, "pseudo", torch.float64, torch.device("cpu"),
+                             seed=0)
+    loader_opts = {"batch_size": 128, "shuffle": True, "seed": 0}
+    for model in models_for(n_assets):
+        losses = []
+        for closure in (DimlessBS(), EQUIVALENT_CLOSURES[name]()):
+            closure.with_dataset(dataset, loader_opts).with_model(model)\
+                .with_device(torch.device("cpu")).with_dtype(torch.float64)
+            closure.next_batch()
+            losses.append(closure.compute_losses())
+        for expected, actual in zip(*losses):
+            torch.testing.assert_close(actual, expected, rtol=1e-10, atol=1e-12)
@@ -0,0 +1,60 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from derpinns import collocations
+from derpinns.collocations import cached_dataset, dataset_key
+from conftest import option_parameters
+
+KEY_SCRIPT = """
+import numpy as np
+from derpinns.collocations import dataset_key
+from conftest import option_parameters
+print(dataset_key(option_parameters(), 100, 20, 5, "Sobol", {seed}))
+"""
+
+
+@pytest.mark.parametrize("seed", ["7", "np.random.SeedSequence(7)", "np.random.SeedSequence(7).spawn(2)[1]"])
+def test_dataset_key_is_stable_across_processes(seed):
+    keys = {subprocess.run([sys.executable, "-c", KEY_SCRIPT.format(seed=seed)], capture_output=True, text=True,
+                           check=True, cwd=__file__.rsplit("/", 1)[0]).stdout for _ in range(2)}
+    assert len(keys) == 1
+    assert keys.pop().strip() == dataset_key(option_parameters(), 100, 20, 5, "Sobol", eval(seed))
+
+
+def test_dataset_key_distinguishes_seeds():
+    params = option_parameters()
+    keys = {dataset_key(params, 100, 20, 5, "pseudo", seed)
+            for seed in (7, 8, np.random.SeedSequence(7), np.random.SeedSequence(7).spawn(1)[0])}
+    assert len(keys) == 4
+    with pytest.raises(ValueError):
+        dataset_key(params, 100, 20, 5, "pseudo", np.random.default_rng(7))
+
+
+@pytest.mark.parametrize("seed", [3, np.random.SeedSequence(3)])
+def test_cached_dataset_round_trip(tmp_path, monkeypatch, seed):
+    params = option_parameters()
+    first = cached_dataset(params, 100, 20, 5, "pseudo", seed, cache_dir=tmp_path)
+    entries = list(tmp_path.iterdir())
+
+    def regenerate(*args, **kwargs):
+        raise AssertionError("the cache was missed")
+    monkeypatch.setattr(collocations, "generate_dataset", regenerate)
+    second = cached_dataset(params, 100, 20, 5, "pseudo", seed, cache_dir=tmp_path)
+    assert list(tmp_path.iterdir()) == entries and len(entries) == 1
+    assert isinstance(second[0], np.memmap) and isinstance(second[2], np.memmap)
+    for a, b in zip(first, second):
+        assert np.array_equal(a, b)
+
+
+def test_cached_dataset_recomputes_targets(tmp_path):
+    def payoff_with(shift):
+        return lambda x: np.maximum(np.exp(x).max(1) - shift, 0)[:, None]
+    for shift in (1.0, 1.5):
+        params = option_parameters()
+        params.payoff = payoff_with(shift)
+        x, y, _ = cached_dataset(params, 100, 20, 5, "pseudo", 3, cache_dir=tmp_path)
+        assert np.array_equal(y, params.payoff(np.asarray(x[100:120])))
+    assert len(list(tmp_path.iterdir())) == 1
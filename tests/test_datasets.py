@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from derpinns.datasets import StratifiedClassBatchSampler
+
+
+def labels_of(sizes):
+    return torch.repeat_interleave(torch.arange(len(sizes)), torch.tensor(sizes))
+
+
+def test_stratified_counts_follow_the_quotas():
+    sampler = StratifiedClassBatchSampler(labels_of([600, 200, 50, 50, 50, 50]), 6, batch_size=100,
+                                          quotas={"interior": 2, "initial": 1, "boundary": 1})
+    assert sampler.counts[:2] == [50, 25]
+    assert sorted(sampler.counts[2:]) == [6, 6, 6, 7]
+    assert sum(sampler.counts) == 100
+    idx, counts = next(iter(sampler))
+    assert torch.bincount(sampler.labels[idx], minlength=6).tolist() == counts
+
+
+def test_stratified_counts_are_clamped_to_the_class_sizes():
+    sizes = [40, 5, 3, 3]
+    sampler = StratifiedClassBatchSampler(labels_of(sizes), 4, batch_size=30, quotas=[1, 1, 1, 1])
+    assert sampler.counts == [19, 5, 3, 3]
+    # larger than the dataset: every point once, none repeated
+    sampler = StratifiedClassBatchSampler(labels_of(sizes), 4, batch_size=100, shuffle=True, seed=0)
+    idx, counts = next(iter(sampler))
+    assert counts == sizes
+    assert len(idx.unique()) == len(idx) == sum(sizes)
+
+
+def test_stratified_counts_keep_every_class():
+    sampler = StratifiedClassBatchSampler(labels_of([1000, 10, 10, 10]), 4, batch_size=4)
+    assert sampler.counts == [1, 1, 1, 1]
+    with pytest.raises(ValueError):
+        StratifiedClassBatchSampler(labels_of([1000, 10, 10, 10]), 4, batch_size=3)
+
+
+def test_stratified_batches_do_not_repeat_points_across_epochs():
+    sampler = StratifiedClassBatchSampler(labels_of([7, 3]), 2, batch_size=5, shuffle=True, seed=0)
+    batches = iter(sampler)
+    seen = torch.cat([next(batches)[0] for _ in range(21)])
+    for idx in seen.view(21, -1):
+        assert len(idx.unique()) == len(idx)
+    # 21 batches of 4 interior points are 12 epochs of the 7 interior points
+    assert torch.bincount(seen[sampler.labels[seen] == 0]).tolist() == [12] * 7
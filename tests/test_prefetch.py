@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from derpinns.prefetch import BatchPrefetcher
+
+
+class CountingClosure:
+    def __init__(self, fail_at=None):
+        self.model = torch.nn.Linear(2, 1)
+        self.watchdog = None
+        self.prefetcher = None
+        self.produced = 0
+        self.fail_at = fail_at
+
+    def produce_batch(self):
+        if self.produced == self.fail_at:
+            raise RuntimeError("producer failed")
+        self.produced += 1
+        return self.produced - 1, self.model
+
+
+def test_prefetch_keeps_the_order_and_syncs_the_model():
+    closure = CountingClosure()
+    prefetcher = BatchPrefetcher(depth=2, sync_every=3).start(closure)
+    try:
+        batches = [prefetcher.get() for _ in range(10)]
+    finally:
+        prefetcher.stop()
+    assert [i for i, _ in batches] == list(range(10))
+    # the producer trains nothing: it scores against frozen snapshots, never the live model
+    assert all(model is not closure.model for _, model in batches)
+    assert not any(p.requires_grad for _, model in batches for p in model.parameters())
+    assert prefetcher.report()["batches"] == 10
+
+
+def test_prefetch_stops_a_blocked_producer():
+    prefetcher = BatchPrefetcher(depth=1).start(CountingClosure())
+    prefetcher.get()
+    thread = prefetcher.thread
+    prefetcher.stop()
+    assert not thread.is_alive()
+    assert prefetcher.thread is None
+
+
+def test_prefetch_raises_producer_errors():
+    prefetcher = BatchPrefetcher(depth=2).start(CountingClosure(fail_at=2))
+    try:
+        assert [prefetcher.get()[0] for _ in range(2)] == [0, 1]
+        with pytest.raises(RuntimeError, match="producer failed"):
+            prefetcher.get()
+    finally:
+        prefetcher.stop()
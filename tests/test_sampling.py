@@ -0,0 +1,22 @@
+import torch
+
+from derpinns.sampling import SumTree
+
+
+def test_sum_tree_samples_proportionally_to_priorities():
+    tree = SumTree(5, dtype=torch.float64)
+    tree.fill(torch.tensor([1.0, 0.0, 3.0, 0.0, 6.0], dtype=torch.float64))
+    generator = torch.Generator().manual_seed(0)
+    share = torch.bincount(tree.sample(200_000, generator), minlength=5) / 200_000
+    assert torch.allclose(share, torch.tensor([0.1, 0.0, 0.3, 0.0, 0.6]), atol=0.01)
+
+
+def test_sum_tree_update_keeps_totals():
+    tree = SumTree(7, dtype=torch.float64)
+    tree.fill(1.0)
+    tree.update(torch.tensor([0, 6]), torch.tensor([0.0, 4.0]))
+    assert tree.total.item() == 9.0
+    generator = torch.Generator().manual_seed(0)
+    samples = tree.sample(50_000, generator)
+    assert (samples != 0).all()
+    assert abs((samples == 6).double().mean().item() - 4 / 9) < 0.01
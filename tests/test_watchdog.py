@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from derpinns.watchdog import NumericsWatchdog
+
+
+def watched(check_every=2, max_rollbacks=1):
+    torch.manual_seed(0)
+    model = torch.nn.Linear(2, 1)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    return model, optimizer, NumericsWatchdog(check_every, max_rollbacks).watch(model, optimizer)
+
+
+def train_step(model, optimizer, watchdog, scale=1.0):
+    optimizer.zero_grad()
+    loss = model(torch.ones(4, 2)).square().mean() * scale
+    watchdog.observe(loss=loss)
+    loss.backward()
+    optimizer.step()
+    return watchdog.step()
+
+
+def test_watchdog_only_checks_every_few_steps():
+    model, optimizer, watchdog = watched(check_every=3)
+    assert not any(train_step(model, optimizer, watchdog) for _ in range(6))
+    assert watchdog.rollbacks == 0 and watchdog.flags == {}
+
+
+def test_watchdog_rolls_back_to_the_last_clean_check():
+    model, optimizer, watchdog = watched()
+    for _ in range(2):
+        train_step(model, optimizer, watchdog)
+    clean = {k: v.clone() for k, v in model.state_dict().items()}
+    assert not train_step(model, optimizer, watchdog, scale=float("nan"))
+    assert train_step(model, optimizer, watchdog)
+    assert watchdog.rollbacks == 1
+    assert all(torch.equal(clean[k], v) for k, v in model.state_dict().items())
+
+
+def test_watchdog_gives_up_after_max_rollbacks():
+    model, optimizer, watchdog = watched(max_rollbacks=1)
+    for _ in range(2):
+        train_step(model, optimizer, watchdog, scale=float("nan"))
+    with pytest.raises(ValueError, match="NaN"):
+        for _ in range(2):
+            train_step(model, optimizer, watchdog, scale=float("nan"))
+
+
+def test_watchdog_catches_non_finite_parameters():
+    model, optimizer, watchdog = watched(check_every=1, max_rollbacks=2)
+    train_step(model, optimizer, watchdog)
+    clean = {k: v.clone() for k, v in model.state_dict().items()}
+    with torch.no_grad():
+        model.weight[0, 0] = float("nan")
+    assert watchdog.check()
+    assert all(torch.equal(clean[k], v) for k, v in model.state_dict().items())
+    # the NaN weights were not taken as the last good snapshot
+    assert all(torch.isfinite(v).all() for v in watchdog.snapshot[0].values())